@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+# Copyright (C) 2019  Alex Schroeder <alex@gnu.org>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark jan-pona-mute against a fake pod running on localhost.
+
+The fake pod serves a synthetic home stream, posts, comments, people
+and notifications. Every scenario starts a new client with empty caches
+in a temporary home directory, runs some commands to get ready, and
+then runs and times the commands to measure. The requests the pod
+receives while the commands run are counted.
+
+The payloads have the shape diaspy-api 0.6.0 expects: notification
+pages with their unread counts, notes with hovercard and post links,
+and people with their streams. The client uses the diaspy that is
+installed, so that is what gets measured."""
+
+import http.server
+import importlib.util
+import contextlib
+import collections
+import urllib.parse
+import threading
+import argparse
+import tempfile
+import calendar
+import copy
+import time
+import json
+import io
+import sys
+import os
+import re
+
+_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jan-pona-mute.py")
+
+_TOKEN = "benchmark-csrf-token"
+_COOKIE = "benchmark-session"
+
+def timestamp(epoch):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(epoch))
+
+class Pod:
+    """Synthetic data for the fake pod: posts, one hour apart, with their
+comments, the people who wrote them, and notifications about them."""
+
+    def __init__(self, posts = 100, comments = 10, notifications = 50, people = 20):
+        start = calendar.timegm((2019, 1, 1, 0, 0, 0))
+        self.people = [{"id": i + 1, "guid": "%032x" % (i + 1), "name": "Person %d" % i,
+                        "diaspora_id": "person%d@pod.example" % i}
+                       for i in range(people)]
+        self.posts = collections.OrderedDict()
+        self.comments = {}
+        comment_id = 1
+        for i in range(posts):
+            id = i + 1
+            created = start + i * 3600
+            self.comments[id] = []
+            for j in range(comments):
+                self.comments[id].append({
+                    "id": comment_id, "guid": "c%d" % comment_id,
+                    "text": "Comment %d on post %d. " % (j + 1, id) * 3,
+                    "created_at": timestamp(created + j * 60),
+                    "author": self.people[(i + j + 1) % people]})
+                comment_id += 1
+            self.posts[id] = {
+                "id": id, "guid": "p%d" % id, "post_type": "StatusMessage", "public": True,
+                "text": "Post number %d.\n\n" % id + "Lorem ipsum dolor sit amet. " * 20,
+                "created_at": timestamp(created),
+                "author": self.people[i % people],
+                "interactions": {"comments_count": comments, "likes_count": 0,
+                                 "reshares_count": 0}}
+        self.notifications = []
+        for i in range(notifications):
+            post = self.posts[posts - i % posts]
+            who = self.people[i % people]
+            # diaspy finds the people and the post in the HTML
+            self.notifications.append({
+                "type": "comment_on_post", "comment_on_post": {
+                    "id": i + 1, "target_type": "Post", "target_id": post["id"],
+                    "unread": True, "created_at": timestamp(start + (posts - i) * 3600),
+                    "note_html": '<div class="media-body"><a href="/people/%s" class="hovercardable">'
+                    '%s</a> commented on your post <a href="/posts/%d" data-ref="%d" '
+                    'class="hard_object_link">Post number %d</a>.</div>'
+                    % (who["guid"], who["name"], post["id"], post["id"], post["id"])}})
+        self.lock = threading.Lock()
+        self.original = copy.deepcopy((self.posts, self.comments, self.notifications))
+
+    def restore(self):
+        """Undo the changes made by a run, e.g. deleted comments."""
+        with self.lock:
+            self.posts, self.comments, self.notifications = copy.deepcopy(self.original)
+
+    def stream(self, max_time, per_page = 15):
+        """Return a page of posts, newest first, older than max_time."""
+        posts = [post for post in reversed(self.posts.values())
+                 if max_time == None or calendar.timegm(time.strptime(
+                         post["created_at"], "%Y-%m-%dT%H:%M:%S.000Z")) < max_time]
+        return posts[:per_page]
+
+    def etag(self, post):
+        return '"%d-%d"' % (post["id"], len(self.comments[post["id"]]))
+
+    def notification_page(self, page, per_page):
+        """Return a page of notifications the way the pod does."""
+        unread = collections.Counter(n["type"] for n in self.notifications if n[n["type"]]["unread"])
+        return {"notification_list": self.notifications[(page - 1) * per_page:page * per_page],
+                "unread_count": sum(unread.values()),
+                "unread_count_by_type": {"also_commented": 0, "comment_on_post": 0, "liked": 0,
+                                         "mentioned": 0, "reshared": 0, "started_sharing": 0,
+                                         **unread}}
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Answer requests like a Diaspora pod would, after a delay."""
+
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def route(self, method):
+        if not self.server.allow():
+            return self.reply(429, {"error": "Too many requests"}, {"Retry-After": "1"})
+        self.server.count(method, self.path)
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path.strip("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else ""
+        pod = self.server.pod
+        with pod.lock:
+            if path == "users/sign_in":
+                if method == "POST":
+                    return self.reply(302, "", {"Location": "/stream",
+                                                "Set-Cookie": "_diaspora_session=%s; path=/" % _COOKIE})
+                return self.html()
+            if path in ("stream", ""):
+                return self.html()
+            if path == "stream.json":
+                max_time = int(params["max_time"]) if "max_time" in params else None
+                # stream elements include the latest comments
+                return self.reply(200, [dict(post, last_three_comments = pod.comments[post["id"]][-3:])
+                                        for post in pod.stream(max_time)])
+            if path == "notifications.json":
+                per_page = int(params.get("per_page", 5))
+                page = int(params.get("page", 1))
+                return self.reply(200, pod.notification_page(page, per_page))
+            m = re.fullmatch(r"notifications/(\d+)", path)
+            if m and method == "PUT":
+                unread = params.get("set_unread") == "true"
+                for n in pod.notifications:
+                    if n[n["type"]]["id"] == int(m.group(1)):
+                        n[n["type"]]["unread"] = unread
+                return self.reply(200, {"guid": int(m.group(1)), "unread": unread})
+            m = re.fullmatch(r"people/(\w+)(?:\.json)?", path)
+            if m:
+                for person in pod.people:
+                    if person["guid"] == m.group(1):
+                        return self.reply(200, person)
+                return self.reply(404, {})
+            m = re.fullmatch(r"people/(\w+)/stream\.json", path)
+            if m:
+                return self.reply(200, [post for post in reversed(pod.posts.values())
+                                        if post["author"]["guid"] == m.group(1)][:15])
+            m = re.fullmatch(r"posts/(\w+)\.json", path)
+            if m and method == "GET":
+                for post in pod.posts.values():
+                    if str(post["id"]) == m.group(1) or post["guid"] == m.group(1):
+                        etag = pod.etag(post)
+                        if self.headers.get("If-None-Match") == etag:
+                            return self.reply(304, None, {"ETag": etag})
+                        return self.reply(200, post, {"ETag": etag})
+                return self.reply(404, {})
+            m = re.fullmatch(r"posts/(\d+)/comments(?:\.json)?", path)
+            if m:
+                id = int(m.group(1))
+                if id not in pod.comments:
+                    return self.reply(404, {})
+                if method == "POST":
+                    text = dict(urllib.parse.parse_qsl(body)).get("text", "")
+                    comment = {"id": 1000000 + sum(len(c) for c in pod.comments.values()),
+                               "text": text, "created_at": timestamp(time.time()),
+                               "author": pod.people[0]}
+                    comment["guid"] = "c%d" % comment["id"]
+                    pod.comments[id].append(comment)
+                    return self.reply(201, comment)
+                return self.reply(200, pod.comments[id])
+            m = re.fullmatch(r"posts/(\d+)/comments/(\d+)", path)
+            if m and method == "DELETE":
+                id = int(m.group(1))
+                pod.comments[id] = [c for c in pod.comments.get(id, []) if str(c["id"]) != m.group(2)]
+                pod.posts[id]["interactions"]["comments_count"] = len(pod.comments[id])
+                return self.reply(204, None)
+            m = re.fullmatch(r"posts/(\d+)", path)
+            if m and method == "DELETE":
+                pod.posts.pop(int(m.group(1)), None)
+                return self.reply(204, None)
+            if path == "status_messages" and method == "POST":
+                text = json.loads(body)["status_message"]["text"]
+                id = max(pod.posts) + 1 if pod.posts else 1
+                post = {"id": id, "guid": "p%d" % id, "post_type": "StatusMessage", "public": True,
+                        "text": text, "created_at": timestamp(time.time()), "author": pod.people[0],
+                        "interactions": {"comments_count": 0, "likes_count": 0, "reshares_count": 0}}
+                pod.posts[id] = post
+                pod.comments[id] = []
+                return self.reply(201, post)
+        return self.reply(404, {})
+
+    def html(self):
+        self.reply(200, '<html><head><meta name="csrf-token" content="%s" /></head>'
+                   '<body><input name="authenticity_token" value="%s" /></body></html>'
+                   % (_TOKEN, _TOKEN), {"Content-Type": "text/html"})
+
+    def reply(self, status, data, headers = {}):
+        if data == None:
+            body = b""
+        elif isinstance(data, str):
+            body = data.encode()
+        else:
+            body = json.dumps(data).encode()
+        self.send_response(status)
+        if not "Content-Type" in headers:
+            self.send_header("Content-Type", "application/json")
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+class Server(http.server.ThreadingHTTPServer):
+    """The fake pod. It counts the requests it gets, by method and path;
+numbers in the path are replaced by N. With a rate limit, requests
+beyond it are answered with 429 and only counted as limited."""
+
+    daemon_threads = True
+
+    def __init__(self, pod, latency, rate_limit = 0):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.pod = pod
+        self.latency = latency
+        self.rate_limit = rate_limit # requests per second, or 0
+        self.second = None
+        self.sent = 0 # requests in this second
+        self.limited = 0
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Return whether the rate limit allows another request."""
+        with self.lock:
+            second = int(time.time())
+            if second != self.second:
+                self.second = second
+                self.sent = 0
+            self.sent += 1
+            if self.rate_limit and self.sent > self.rate_limit:
+                self.limited += 1
+                return False
+            return True
+
+    def count(self, method, path):
+        path = urllib.parse.urlsplit(path).path
+        path = re.sub(r"\d+", "N", re.sub(r"[0-9a-f]{32}", "N", path))
+        with self.lock:
+            self.requests["%s %s" % (method, path)] += 1
+
+    def reset(self):
+        with self.lock:
+            counts = self.requests
+            self.requests = collections.Counter()
+            self.limited = 0
+            return counts
+
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+# Each scenario is a name, the commands to get ready, and the commands
+# to measure.
+SCENARIOS = [
+    ("home all", [], ["home", "home all"]),
+    ("home more", ["home"], ["home more", "home more", "home more"]),
+    ("notifications update", [], ["notifications update"]),
+    ("show N", ["notifications"], ["show 1", "show 2", "show 3", "show 4", "show 5"]),
+    ("comments all", ["notifications", "show 1"], ["comments all"]),
+    ("latest comments", ["home", "show 1"], ["comments 3"]),
+    ("reload", ["home", "show 1", "comments all"], ["reload"]),
+    ("delete comment", ["notifications", "show 1"], ["delete comment 1", "delete comment 1"]),
+    ("delete comments", ["notifications", "show 1"], ["delete comment 1-5"]),
+    ("read notifications", ["notifications"], ["notifications read all"]),
+]
+
+# The most requests a scenario may send, in total and by method and
+# path, as measured with diaspy-api 0.6.0. The budgets don't depend on
+# the number of posts, comments or notifications, except where noted.
+BUDGETS = {
+    "home all": {"total": 1},
+    "home more": {"total": 3}, # one page each
+    # diaspy fetches a CSRF token from /stream for every page of
+    # notifications; posts and people for one page of notifications
+    "notifications update": {"total": 14, "GET /notifications.json": 2, "GET /stream": 2,
+                             "GET /posts/N.json": 5, "GET /posts/N/comments.json": 0,
+                             "GET /people/N.json": 5, "GET /people/N/stream.json": 0},
+    "show N": {"total": 5, "GET /people/N.json": 0}, # a post each
+    "comments all": {"total": 1},
+    "latest comments": {"total": 0}, # the stream includes them
+    "reload": {"total": 1, "GET /posts/N/comments.json": 0},
+    # writing uses the CSRF token we have
+    "delete comment": {"total": 3, "DELETE /posts/N/comments/N": 2, "GET /stream": 0},
+    "delete comments": {"total": 6, "DELETE /posts/N/comments/N": 5, "GET /stream": 0},
+    "read notifications": {"total": 5, "GET /stream": 0}, # one page of notifications
+}
+
+# The fewest requests a scenario must send. Fewer means that a command
+# failed without saying so.
+MINIMUMS = {
+    "home all": {"GET /stream.json": 1},
+    "home more": {"GET /stream.json": 3},
+    "notifications update": {"GET /notifications.json": 1, "GET /people/N.json": 1},
+    "comments all": {"GET /posts/N/comments.json": 1},
+    "reload": {"GET /posts/N.json": 1},
+    "delete comment": {"DELETE /posts/N/comments/N": 2},
+    "delete comments": {"DELETE /posts/N/comments/N": 5},
+    "read notifications": {"PUT /notifications/N": 5},
+}
+
+# What the commands of a scenario must print, at least once per
+# command, for the scenarios that need no requests at all.
+OUTPUT = {
+    "show N": r"Post number \d+",
+    "latest comments": r"Comment \d+ on post \d+",
+}
+
+def load_client():
+    """Load jan-pona-mute.py anew, so that nothing is shared between runs."""
+    spec = importlib.util.spec_from_file_location("jan_pona_mute", _SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run(server, setup, commands):
+    """Run the commands with a new client and empty caches.
+Return the seconds it took, the requests counted, the number of
+requests refused by the rate limit, what the commands printed, and the
+problems found: commands that failed and items left in the outbox."""
+    server.pod.restore()
+    problems = []
+    with tempfile.TemporaryDirectory() as home:
+        os.environ["HOME"] = home
+        module = load_client()
+        client = module.DiasporaClient()
+        client.pager = None
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for line in ["account bench@%s" % server.url(), "password secret", "login"] + setup:
+                client.onecmd(line)
+            outbox_drained(client)
+            prefetched(client)
+            problems += failures(client, "getting ready")
+            server.reset()
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            start = time.perf_counter()
+            for line in commands:
+                client.onecmd(line)
+            outbox_drained(client)
+            seconds = time.perf_counter() - start
+            # the requests made in the background count, too
+            prefetched(client)
+            limited = server.limited
+            requests = server.reset()
+            problems += failures(client, "running")
+            client.onecmd("offline") # stop the background threads
+        return seconds, requests, limited, output.getvalue(), problems
+
+def failures(client, doing):
+    """Return the problems of the client: the exit status says a command
+failed, or the outbox still has items."""
+    problems = []
+    if client.status != 0:
+        problems.append("%s, a command failed with exit status %d" % (doing, client.status))
+        client.status = 0
+    for item in client.get_store().outbox() if client.store else []:
+        problems.append("%s, '%s' was not sent: %s" % (doing, item, item.error or "still waiting"))
+    return problems
+
+def outbox_drained(client, timeout = 30):
+    """Wait until the client has sent everything in the outbox, and is
+done with the batch it was sending."""
+    deadline = time.time() + timeout
+    while (client.store and client.get_store().outbox() or client.sending) and time.time() < deadline:
+        time.sleep(0.01)
+
+def prefetched(client, timeout = 30):
+    """Wait until the client has fetched the posts it is prefetching."""
+    deadline = time.time() + timeout
+    while client.prefetching and time.time() < deadline:
+        time.sleep(0.01)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+def benchmark(server, scenarios, runs):
+    """Run every scenario a number of times. Return a list of results."""
+    results = []
+    for name, setup, commands in scenarios:
+        times = []
+        requests = collections.Counter()
+        most = collections.Counter() # the most requests in a single run
+        least = None # the fewest requests in a single run
+        limited = 0
+        problems = []
+        for i in range(runs):
+            seconds, counts, refused, output, failed = run(server, setup, commands)
+            limited += refused
+            problems += ["%s: %s" % (name, problem) for problem in failed]
+            if name in OUTPUT and len(re.findall(OUTPUT[name], output)) < len(commands):
+                problems.append("%s: '%s' is printed less than once per command" % (name, OUTPUT[name]))
+            times.append(seconds * 1000)
+            requests.update(counts)
+            counts["total"] = sum(counts.values())
+            most |= counts
+            least = counts if least == None else least & counts
+        results.append({"scenario": name, "runs": runs,
+                        "p50 ms": percentile(times, 50), "p95 ms": percentile(times, 95),
+                        "requests": sum(requests.values()) / runs, "limited": limited / runs,
+                        "by path": {path: n / runs for path, n in sorted(requests.items())},
+                        "most": dict(most), "least": dict(least or {}),
+                        "problems": sorted(set(problems))})
+    return results
+
+def check(results):
+    """Compare the requests with the budgets and the minimums. Return the
+problems found."""
+    problems = []
+    for result in results:
+        for key, limit in BUDGETS.get(result["scenario"], {}).items():
+            n = result["most"].get(key, 0)
+            if n > limit:
+                problems.append("%s: %d requests (%s), the budget is %d" % (
+                    result["scenario"], n, key, limit))
+        for key, limit in MINIMUMS.get(result["scenario"], {}).items():
+            n = result["least"].get(key, 0)
+            if n < limit:
+                problems.append("%s: %d requests (%s), at least %d expected" % (
+                    result["scenario"], n, key, limit))
+    return problems
+
+def report(results, verbose):
+    print("%-22s %5s %9s %9s %9s" % ("scenario", "runs", "p50 ms", "p95 ms", "requests"))
+    for result in results:
+        print("%-22s %5d %9.1f %9.1f %9.1f" % (
+            result["scenario"], result["runs"], result["p50 ms"], result["p95 ms"], result["requests"]))
+        if verbose:
+            for path, n in result["by path"].items():
+                print("    %-40s %9.1f" % (path, n))
+            if result["limited"]:
+                print("    %-40s %9.1f" % ("refused by the rate limit", result["limited"]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark jan-pona-mute against a fake pod.')
+    parser.add_argument('--posts', type=int, default=100, help='Posts in the home stream')
+    parser.add_argument('--comments', type=int, default=10, help='Comments per post')
+    parser.add_argument('--notifications', type=int, default=50, help='Notifications')
+    parser.add_argument('--latency', type=float, default=20, help='Milliseconds the pod takes to answer')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='Requests per second the pod answers before it answers 429')
+    parser.add_argument('--runs', type=int, default=5, help='Runs per scenario')
+    parser.add_argument('--scenario', action='append', help='Only run this scenario; may be repeated')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to this file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the requests by path')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit with status 1 if a scenario sent more requests than its budget')
+    args = parser.parse_args()
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s[0] in args.scenario]
+    if not scenarios:
+        print("Unknown scenario. Use one of: %s" % ", ".join(s[0] for s in SCENARIOS))
+        sys.exit(2)
+    server = Server(Pod(args.posts, args.comments, args.notifications), args.latency / 1000, args.rate_limit)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    results = benchmark(server, scenarios, args.runs)
+    server.shutdown()
+    report(results, args.verbose)
+    problems = [problem for result in results for problem in result["problems"]]
+    for problem in problems:
+        print(problem)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({"posts": args.posts, "comments": args.comments,
+                       "notifications": args.notifications, "latency": args.latency,
+                       "rate limit": args.rate_limit,
+                       "results": results}, fp, indent = 2)
+    if args.check:
+        over = check(results)
+        for problem in over:
+            print(problem)
+        problems += over
+        if not problems:
+            print("All scenarios are within their request budgets.")
+    if problems:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -14,15 +14,63 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
-import diaspy
-import subprocess
+import time
+_START = time.perf_counter()
+
+import importlib.util
+import collections
+import codecs
+import itertools
 import argparse
+import calendar
+import math
+import bisect
+import threading
 import shutil
+import io
+import json
 import cmd
 import sys
 import os
 import re
 
+class LazyModule:
+    """Stands in for a module until one of its attributes is used, and
+imports it then. Unlike importlib's LazyLoader before Python 3.12, this
+is thread-safe: background threads are often the first to use a module."""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module == None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+def lazy_import(name):
+    """Import a module the first time one of its attributes is used."""
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) == None:
+        return importlib.import_module(name) # raises the usual error
+    return LazyModule(name)
+
+# these take a while to import and aren't needed to get to the prompt
+diaspy = lazy_import("diaspy")
+sqlite3 = lazy_import("sqlite3")
+subprocess = lazy_import("subprocess")
+hashlib = lazy_import("hashlib")
+termios = lazy_import("termios")
+fcntl = lazy_import("fcntl")
+struct = lazy_import("struct")
+pty = lazy_import("pty")
+requests = lazy_import("requests")
+random = lazy_import("random")
+futures = lazy_import("concurrent.futures")
+
+_IMPORTED = time.perf_counter()
+
 _RC_PATHS = (
     "~/.config/jan-pona-mute/login",
     "~/.jan-pona-mute.d/login"
@@ -34,6 +82,10 @@ _NOTE_DIRS = (
     "~/.jan-pona-mute.d/notes"
 )
 
+_CACHE_FILE = "~/.config/jan-pona-mute/cache.db"
+
+_SESSION_FILE = "~/.config/jan-pona-mute/session"
+
 _PAGERS = (
     os.getenv("PAGER"),
     "mdcat",
@@ -41,12 +93,37 @@ _PAGERS = (
     "cat"
 )
 
+# pagers that need the terminal; their output can't be cached
+_INTERACTIVE_PAGERS = ("less", "more", "most", "pg", "lv", "w3m")
+
+# commands that may have to wait for the pod; at the prompt, they run
+# in a worker thread so that they can be cancelled or sent to the
+# background; showing a post may have to load it
+_SLOW_COMMANDS = ("login", "home", "notifications", "comments", "reload",
+                  "show", "next", "previous")
+
+# outbox actions that don't depend on each other; a run of them is
+# sent concurrently
+_PARALLEL_ACTIONS = ("delete post", "delete comment", "read notification")
+
 _EDITORS = (
     os.getenv("EDITOR"),
     "vi",
     "ed"
 )
 
+# exit codes in batch mode
+_EXIT_OK = 0
+_EXIT_ERROR = 1
+_EXIT_USAGE = 2
+_EXIT_OFFLINE = 3
+_EXIT_LOGIN = 4
+
+# request priorities, most urgent first
+_PRIORITY_INTERACTIVE = 0
+_PRIORITY_PREFETCH = 1
+_PRIORITY_POLLING = 2
+
 shortcuts = {
     "q":    "quit",
     "p":    "preview",
@@ -82,6 +159,41 @@ def get_notes_dir():
         os.makedirs(dir)
     return dir
 
+def get_cache_file():
+    """Disk cache finder"""
+    path = os.path.expanduser(_CACHE_FILE)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return path
+
+def load_session(account):
+    """Get the saved session for the account, or None."""
+    try:
+        with open(os.path.expanduser(_SESSION_FILE), "r") as fp:
+            session = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if session.get("account") != account:
+        return None
+    return session
+
+def save_session(account, cookies, token):
+    """Save the session cookies and CSRF token, readable only by the user."""
+    path = os.path.expanduser(_SESSION_FILE)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fp:
+        json.dump({"account": account, "token": token, "cookies": [
+            {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path}
+            for c in cookies]}, fp)
+
+def forget_session():
+    """Delete the saved session."""
+    path = os.path.expanduser(_SESSION_FILE)
+    if os.path.exists(path):
+        os.unlink(path)
+
 def get_binary(list):
     for cmd in list:
         if cmd != None:
@@ -97,6 +209,824 @@ def get_editor():
     """Editor finder"""
     return get_binary(_EDITORS)
 
+def parse_time(string):
+    """Seconds since the epoch for a timestamp such as 2019-08-13T19:40:17.000Z"""
+    try:
+        return calendar.timegm(time.strptime(string[:19], "%Y-%m-%dT%H:%M:%S"))
+    except (TypeError, ValueError):
+        return 0
+
+def retry_after(response, default):
+    """Seconds to wait according to the Retry-After header of a response,
+which is either a number of seconds or a date"""
+    value = response.headers.get("retry-after")
+    if value == None:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = calendar.timegm(time.strptime(value.strip(), "%a, %d %b %Y %H:%M:%S GMT"))
+    except ValueError:
+        return default
+    return max(0, date - time.time())
+
+def parse_numbers(words, count):
+    """List the numbers given by words like 3, 5-7 or all, from 1 to count.
+Raise ValueError if a word isn't a number or a range, and IndexError if
+a number is out of range."""
+    numbers = []
+    for word in words:
+        if word == "all":
+            numbers.extend(range(1, count + 1))
+            continue
+        start, dash, end = word.partition("-")
+        start = int(start)
+        end = int(end) if dash else start
+        if start < 1 or end > count:
+            raise IndexError(word)
+        numbers.extend(range(start, end + 1))
+    if not numbers:
+        raise IndexError("nothing")
+    return list(dict.fromkeys(numbers))
+
+def comment_count(post):
+    """Number of comments on a post, even if we haven't fetched them"""
+    return max(post.comments_count, len(post.comments))
+
+def update_comment_count(post):
+    """Set the number of comments of a post after adding or deleting
+one, so that it stays right in the disk cache"""
+    post.comments_count = len(post.comments)
+
+def embedded_comments(data):
+    """The latest comments included in the post data, if any"""
+    return data.get("last_three_comments") or data.get("interactions", {}).get("comments") or []
+
+def post_size(post):
+    """Approximate number of bytes used by a post and its comments;
+the interned author names are shared and don't count"""
+    return sum(sys.getsizeof(record) + sys.getsizeof(record.text)
+               for record in itertools.chain([post], post.comments))
+
+def intern(string):
+    """Share equal strings, such as the names of authors of many posts"""
+    return sys.intern(string) if isinstance(string, str) else string
+
+def percentile(values, p):
+    """The value below which p percent of the values fall (nearest rank)"""
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+class Stats:
+    """Timings and counters for every command run. Counters are added to
+the command running at the time, even if a background thread did the
+work. Each record can also be written to a trace file as JSON Lines."""
+
+    def __init__(self):
+        self.records = collections.defaultdict(list) # key is the command name
+        self.record = None # the command running
+        self.counters = None # the client's counters when the command started
+        self.started = None
+        self.trace = None # file object
+        self.lock = threading.Lock()
+
+    def start(self, name, line, counters):
+        """Start recording a command."""
+        with self.lock:
+            self.record = {"command": name, "line": line,
+                           "http requests": 0, "http bytes": 0, "pager": 0.0}
+            self.counters = counters
+            self.started = time.perf_counter()
+
+    def add(self, key, value):
+        """Add to a counter of the command running."""
+        with self.lock:
+            if self.record != None:
+                self.record[key] += value
+
+    def stop(self, counters):
+        """Stop recording the command and return its record."""
+        with self.lock:
+            record = self.record
+            self.record = None
+            record["time"] = time.perf_counter() - self.started
+            for key, value in counters.items():
+                record[key] = value - self.counters[key]
+            self.records[record["command"]].append(record)
+            if self.trace:
+                self.trace.write(json.dumps(dict(record, at = time.time())) + "\n")
+                self.trace.flush()
+            return record
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def summary(self):
+        """Return lines with p50 and p95 times and averages per command."""
+        lines = ["%-14s %5s %8s %8s %6s %8s %8s" % (
+            "command", "runs", "p50 ms", "p95 ms", "http", "KiB", "pager ms")]
+        with self.lock:
+            for name in sorted(self.records):
+                records = self.records[name]
+                times = [record["time"] * 1000 for record in records]
+                n = len(records)
+                lines.append("%-14s %5d %8.1f %8.1f %6.1f %8.1f %8.1f" % (
+                    name, n, percentile(times, 50), percentile(times, 95),
+                    sum(record["http requests"] for record in records) / n,
+                    sum(record["http bytes"] for record in records) / n / 1024,
+                    sum(record["pager"] for record in records) / n * 1000))
+        return lines
+
+class Scheduler:
+    """Decide when requests go out to the pod. Every request takes a
+token from a bucket that refills at a steady rate; if the pod says we
+are sending too much, nothing goes out until it says we may try again.
+Waiting requests go out in order of priority. A request for something
+that is already on its way waits for that answer instead."""
+
+    rate = 10 # tokens per second, or 0 for no limit
+    burst = 20 # tokens the bucket holds
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.paused_until = 0
+        self.waiting = [] # tickets of the requests waiting for a token
+        self.in_flight = {} # key is the request, value is (ticket, future)
+        self.local = threading.local()
+        self.limited = 0 # times the pod said we were sending too much
+        self.coalesced = 0 # requests that waited for another one's answer
+        self.waited = 0.0 # seconds spent waiting for tokens
+
+    def set_priority(self, priority):
+        """Set the priority of the requests sent by the current thread."""
+        self.local.priority = priority
+
+    def priority(self):
+        """Return the priority of the requests sent by the current thread."""
+        return getattr(self.local, "priority", _PRIORITY_INTERACTIVE)
+
+    def ticket(self):
+        """Return a ticket for a new request. It's a list holding the
+priority, so that the priority can be raised while the request waits."""
+        return [self.priority()]
+
+    def acquire(self, ticket):
+        """Wait until the request with this ticket may go out."""
+        start = time.monotonic()
+        with self.lock:
+            self.waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self.rate:
+                        self.tokens = min(max(1, self.burst), self.tokens + (now - self.refilled) * self.rate)
+                    else:
+                        self.tokens = max(1, self.burst)
+                    self.refilled = now
+                    if now < self.paused_until:
+                        delay = self.paused_until - now
+                    elif ticket[0] > min(other[0] for other in self.waiting):
+                        delay = None # a more urgent request goes first
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    else:
+                        delay = (1 - self.tokens) / self.rate
+                    self.lock.wait(delay)
+            finally:
+                self.waiting = [other for other in self.waiting if other is not ticket]
+                self.waited += time.monotonic() - start
+                self.lock.notify_all()
+
+    def pause(self, seconds):
+        """Send nothing for a while because the pod asked us to."""
+        with self.lock:
+            self.limited += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.lock.notify_all()
+
+    def coalesce(self, key, ticket, send):
+        """Call send and return its result, unless a request with the same
+key is on its way: then raise its priority if ours is more urgent and
+return its result instead."""
+        with self.lock:
+            pending = self.in_flight.get(key)
+            if pending:
+                pending[0][0] = min(pending[0][0], ticket[0])
+                self.coalesced += 1
+                self.lock.notify_all()
+            else:
+                future = futures.Future()
+                self.in_flight[key] = (ticket, future)
+        if pending:
+            return pending[1].result()
+        try:
+            result = send()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+class LRUCache:
+    """A dictionary that forgets the least recently used entries once it
+holds more than the maximum number of entries or bytes. The size of
+an entry is determined by the sizeof function. It's safe to use from
+background threads."""
+
+    def __init__(self, max_entries, max_bytes, sizeof = sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.entries[key]
+            self.entries.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.sizes[key]
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.sizes[key] = size
+            self.bytes += size
+            self.shrink()
+
+    def get(self, key, default = None):
+        """Get an entry and count it as a hit or a miss."""
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                return self[key]
+            self.misses += 1
+            return default
+
+    def pop(self, key, default = None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.bytes -= self.sizes.pop(key)
+            return self.entries.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+
+    def shrink(self):
+        """Evict the least recently used entries until we're within budget.
+The last entry is never evicted, even if it is too big."""
+        with self.lock:
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries
+                                             or self.bytes > self.max_bytes):
+                key, value = self.entries.popitem(last = False)
+                self.bytes -= self.sizes.pop(key)
+                self.evictions += 1
+
+    def items(self):
+        """Return a list of the keys and values, without using them."""
+        with self.lock:
+            return list(self.entries.items())
+
+    def stats(self):
+        """Return a one line summary."""
+        return "%d entries, ~%d KiB, %d hits, %d misses, %d evictions" % (
+            len(self.entries), self.bytes // 1024, self.hits, self.misses, self.evictions)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+class PostIndex:
+    """Post ids sorted by creation time, oldest first.
+New posts are inserted in the right place, so the posts never need to
+be sorted again and the nth post id can be looked up directly. The
+posts themselves are kept in the caches."""
+
+    def __init__(self):
+        self.keys = []
+        self.ids = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __getitem__(self, n):
+        return self.ids[n]
+
+    def __contains__(self, id):
+        return str(id) in self.ids
+
+    def add(self, post):
+        """Add a post unless it is already in the index.
+Return True if it was added."""
+        key = (parse_time(post.created_at), str(post.id))
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return False
+        self.keys.insert(i, key)
+        self.ids.insert(i, key[1])
+        return True
+
+    def remove(self, id):
+        """Remove a post id, if it is in the index."""
+        if str(id) in self.ids:
+            i = self.ids.index(str(id))
+            del self.keys[i]
+            del self.ids[i]
+
+    def oldest(self):
+        """Seconds since the epoch of the oldest post, or None."""
+        return self.keys[0][0] if self.keys else None
+
+class CommentRecord:
+    """A comment with just the fields we show. The pod sends a lot more;
+data() returns what we keep, in the format of the pod."""
+
+    __slots__ = ("id", "guid", "created_at", "text", "author", "handle", "author_guid")
+
+    def __init__(self, data):
+        author = data.get("author") or {}
+        self.id = data["id"]
+        self.guid = data.get("guid")
+        self.created_at = data.get("created_at")
+        self.text = data.get("text")
+        self.author = intern(author.get("name"))
+        self.handle = intern(author.get("diaspora_id"))
+        self.author_guid = intern(author.get("guid"))
+
+    def __str__(self):
+        return self.text or ""
+
+    def data(self):
+        return {"id": self.id, "guid": self.guid, "created_at": self.created_at,
+                "text": self.text, "author": {"name": self.author, "diaspora_id": self.handle,
+                                              "guid": self.author_guid}}
+
+class PostRecord(CommentRecord):
+    """A post with just the fields we show, and its comments. Writing
+needs no diaspy post; see DiasporaClient.write."""
+
+    __slots__ = ("comments_count", "comments")
+
+    def __init__(self, data, comments):
+        super().__init__(data)
+        self.comments_count = (data.get("interactions") or {}).get("comments_count", 0)
+        self.comments = CommentStore([CommentRecord(c) for c in comments], self.comments_count)
+
+    def data(self):
+        data = super().data()
+        data["interactions"] = {"comments_count": self.comments_count}
+        return data
+
+class CommentStore:
+    """The comments of a post, oldest first, indexed by comment id.
+We may only know the latest comments: offset is the number of older
+comments we haven't fetched. Positions count all the comments, so the
+first comment we know is at position offset. Comments are looked up
+and removed by id without rebuilding the list. It can be used where
+diaspy expects its Comments."""
+
+    def __init__(self, comments = [], total = 0):
+        self.comments = collections.OrderedDict((str(c.id), c) for c in comments)
+        self.offset = max(0, total - len(self.comments))
+
+    def __len__(self):
+        return self.offset + len(self.comments)
+
+    def __iter__(self):
+        return iter(list(self.comments.values()))
+
+    def __getitem__(self, n):
+        """Return the comment at position n, if we know it."""
+        if n < 0:
+            n += len(self)
+        comments = self.window(n, n + 1)
+        if n < self.offset or not comments:
+            raise IndexError("comment %d is unknown" % n)
+        return comments[0]
+
+    def has(self, start):
+        """Return True if we know the comments from position start on."""
+        return max(start, 0) >= self.offset
+
+    def window(self, start, end):
+        """Return the comments we know from position start to end."""
+        start = max(start - self.offset, 0)
+        end = max(end - self.offset, start)
+        return list(itertools.islice(self.comments.values(), start, end))
+
+    def get(self, id):
+        return self.comments.get(str(id))
+
+    def add(self, comment):
+        self.comments[str(comment.id)] = comment
+
+    def insert(self, comment):
+        """Put a comment back in its place, by creation time."""
+        self.comments[str(comment.id)] = comment
+        self.comments = collections.OrderedDict(
+            sorted(self.comments.items(), key = lambda item: item[1].created_at or ""))
+
+    def remove(self, id):
+        """Remove a comment, if we know it."""
+        return self.comments.pop(str(id), None)
+
+    def set(self, comments):
+        """Replace the comments with all the comments of the post."""
+        self.comments = collections.OrderedDict((str(c.id), c) for c in comments)
+        self.offset = 0
+
+    def ids(self):
+        return [comment.id for comment in self.comments.values()]
+
+def tokenize(text):
+    """The lower case words in a text, for searching"""
+    return re.findall(r"\w+", text.lower())
+
+class SearchIndex:
+    """An inverted index mapping words to the documents containing them.
+Documents are added and removed by key; adding a key again replaces
+the document. A search returns the keys of the documents containing
+all the terms, best matches first: rare words count for more than
+common words, and a word appearing more often counts for more."""
+
+    def __init__(self):
+        self.postings = collections.defaultdict(dict) # word to key to count
+        self.documents = {} # key to the set of its words
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, key):
+        return key in self.documents
+
+    def add(self, key, text):
+        with self.lock:
+            self.remove(key)
+            counts = collections.Counter(tokenize(text))
+            for word, n in counts.items():
+                self.postings[word][key] = n
+            self.documents[key] = set(counts)
+
+    def remove(self, key):
+        with self.lock:
+            for word in self.documents.pop(key, ()):
+                del self.postings[word][key]
+                if not self.postings[word]:
+                    del self.postings[word]
+
+    def search(self, terms):
+        """Return the keys of the documents containing all the terms."""
+        terms = tokenize(" ".join(terms))
+        if not terms:
+            return []
+        with self.lock:
+            postings = [self.postings.get(term, {}) for term in terms]
+            postings.sort(key = len)
+            keys = set(postings[0])
+            for posting in postings[1:]:
+                keys.intersection_update(posting)
+            n = len(self.documents)
+            scores = {key: sum(posting[key] * math.log(1 + n / len(posting))
+                               for posting in postings)
+                      for key in keys}
+        return sorted(keys, key = lambda key: scores[key], reverse = True)
+
+class NotesIndex:
+    """The names and contents of the notes, kept in memory.
+The list of names is only read again when the modification time of
+the notes directory changes, and a note is only read again when its
+own modification time changes. The contents are indexed for search."""
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.mtime = None
+        self.names = []
+        self.contents = {} # name to (mtime, text)
+        self.index = SearchIndex()
+
+    def list(self):
+        """Return the sorted names of the notes."""
+        mtime = os.stat(self.dir).st_mtime_ns
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.names = sorted(name for name in os.listdir(self.dir) if not name.endswith("~"))
+            for name in set(self.contents) - set(self.names):
+                del self.contents[name]
+                self.index.remove(name)
+        return self.names
+
+    def read(self, name):
+        """Return the text of a note."""
+        path = os.path.join(self.dir, name)
+        mtime = os.stat(path).st_mtime_ns
+        if name not in self.contents or self.contents[name][0] != mtime:
+            with open(path, mode = 'r', encoding = 'utf-8') as fp:
+                text = fp.read()
+            self.contents[name] = (mtime, text)
+            self.index.add(name, name + "\n" + text)
+        return self.contents[name][1]
+
+    def search(self, terms):
+        """Return the names of the notes containing all the terms."""
+        for name in self.list():
+            try:
+                self.read(name)
+            except (OSError, UnicodeDecodeError):
+                pass # not a text file
+        return self.index.search(terms)
+
+    def invalidate(self):
+        """Read the directory again, e.g. after changing it ourselves."""
+        self.mtime = None
+
+class StoreEntry:
+    """A post as found in the disk cache."""
+
+    def __init__(self, data, comments, etag, fetched, ttl):
+        self.data = data
+        self.comments = comments
+        self.etag = etag
+        self.fetched = fetched
+        self.fresh = time.time() - fetched < ttl
+
+class OutboxItem:
+    """A comment, post or deletion waiting to be sent."""
+
+    def __init__(self, seq, action, args, attempts, error):
+        self.seq = seq
+        self.action = action
+        self.args = args
+        self.attempts = attempts
+        self.error = error
+
+    def __str__(self):
+        if self.action == "comment":
+            return "comment on post %s: %s" % (self.args["post"], self.args["text"][:40])
+        elif self.action == "post":
+            return "post: %s" % self.args["text"][:40]
+        elif self.action == "delete post":
+            return "delete post %s" % self.args["post"]
+        elif self.action == "delete comment":
+            return "delete comment %s from post %s" % (self.args["comment"], self.args["post"])
+        elif self.action == "read notification":
+            return "mark notification %s as %s" % (
+                self.args["notification"], "unread" if self.args["unread"] else "read")
+        return self.action
+
+class Job:
+    """A slow command running in a worker thread."""
+
+    def __init__(self, line):
+        self.line = line
+        self.thread = None
+        self.done = threading.Event()
+        self.detached = False # its output is held until 'wait'
+        self.output = "" # what it printed while detached
+
+class Output:
+    """Standard output that holds what commands running in the background
+print, so that it doesn't end up in the middle of the prompt."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.held = {} # key is the thread, value is a StringIO
+
+    def write(self, text):
+        buffer = self.held.get(threading.current_thread())
+        return (self.stream if buffer == None else buffer).write(text)
+
+    def hold(self, thread):
+        self.held.setdefault(thread, io.StringIO())
+
+    def release(self, thread):
+        """Stop holding the output of the thread and return what it printed."""
+        buffer = self.held.pop(thread, None)
+        return buffer.getvalue() if buffer else ""
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class PostStore:
+    """Disk cache for posts and their comments.
+Posts are stored as the JSON of their records, with just the fields we
+show (see PostRecord.data), keyed by id and guid. Entries older than the TTL (in seconds) are stale and need to be
+revalidated before use. The database connection is shared by all
+threads, so every access holds the lock."""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("""create table if not exists posts (
+            id text primary key, guid text, data text, comments text,
+            etag text, fetched real)""")
+        self.db.execute("create index if not exists posts_guid on posts (guid)")
+        self.db.execute("""create table if not exists streams (
+            name text primary key, ids text, fetched real)""")
+        self.db.execute("""create table if not exists users (
+            guid text primary key, handle text, fetched real)""")
+        self.db.execute("""create table if not exists notifications (
+            id text primary key, data text, created text)""")
+        self.db.execute("""create table if not exists renders (
+            key text primary key, output text, used real)""")
+        self.db.execute("""create table if not exists outbox (
+            seq integer primary key autoincrement, action text, args text,
+            created real, attempts integer, error text)""")
+        self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("select count(*) from posts").fetchone()[0]
+
+    def get(self, id):
+        """Get the entry for a post id or guid, or None."""
+        with self.lock:
+            row = self.db.execute(
+                "select data, comments, etag, fetched from posts where id = ? or guid = ?",
+                (str(id), str(id))).fetchone()
+        if row == None:
+            return None
+        return StoreEntry(json.loads(row[0]), json.loads(row[1]), row[2], row[3], self.ttl)
+
+    def put(self, post, etag = None):
+        """Store a post and its comments. Without a new ETag, keep the one
+we have, so that the post can still be revalidated."""
+        comments = [comment.data() for comment in post.comments]
+        with self.lock:
+            self.db.execute("""insert into posts values (?, ?, ?, ?, ?, ?)
+                on conflict (id) do update set guid = excluded.guid, data = excluded.data,
+                comments = excluded.comments, etag = coalesce(excluded.etag, posts.etag),
+                fetched = excluded.fetched""",
+                            (str(post.id), post.guid, json.dumps(post.data()),
+                             json.dumps(comments), etag, time.time()))
+            self.db.commit()
+
+    def posts(self):
+        """Return the id, data and comment data of all the posts."""
+        with self.lock:
+            rows = self.db.execute("select id, data, comments from posts").fetchall()
+        return [(row[0], json.loads(row[1]), json.loads(row[2])) for row in rows]
+
+    def touch(self, id):
+        """Mark a post as fresh after revalidation."""
+        with self.lock:
+            self.db.execute("update posts set fetched = ? where id = ?", (time.time(), str(id)))
+            self.db.commit()
+
+    def delete(self, id):
+        """Remove a post."""
+        with self.lock:
+            self.db.execute("delete from posts where id = ?", (str(id),))
+            self.db.commit()
+
+    def get_stream(self, name):
+        """Get the list of post ids of a stream and whether it is fresh."""
+        with self.lock:
+            row = self.db.execute("select ids, fetched from streams where name = ?", (name,)).fetchone()
+        if row == None:
+            return None, False
+        return json.loads(row[0]), time.time() - row[1] < self.ttl
+
+    def put_stream(self, name, ids):
+        """Store the list of post ids of a stream."""
+        with self.lock:
+            self.db.execute("replace into streams values (?, ?, ?)",
+                            (name, json.dumps([str(id) for id in ids]), time.time()))
+            self.db.commit()
+
+    def get_users(self, guids, ttl):
+        """Get a dict mapping guids to handles for those we know and that
+are younger than the TTL."""
+        users = {}
+        guids = list(guids)
+        with self.lock:
+            for i in range(0, len(guids), 500):
+                batch = guids[i:i+500]
+                rows = self.db.execute(
+                    "select guid, handle from users where fetched > ? and guid in (%s)"
+                    % ",".join("?" * len(batch)), [time.time() - ttl] + batch)
+                users.update(rows)
+        return users
+
+    def put_users(self, users):
+        """Store a dict mapping guids to handles."""
+        now = time.time()
+        with self.lock:
+            self.db.executemany("replace into users values (?, ?, ?)",
+                                [(guid, handle, now) for guid, handle in users.items()])
+            self.db.commit()
+
+    def get_notifications(self):
+        """Get the data of the stored notifications, newest first."""
+        with self.lock:
+            rows = self.db.execute("select data from notifications order by created desc").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def put_notifications(self, notifications):
+        """Store notifications, replacing the ones stored before."""
+        rows = [(str(n.id), json.dumps({n.type: n._data, "type": n.type}), n.when())
+                for n in notifications]
+        with self.lock:
+            self.db.execute("delete from notifications")
+            self.db.executemany("insert or replace into notifications values (?, ?, ?)", rows)
+            self.db.commit()
+
+    def enqueue(self, action, args):
+        """Add an action to the outbox and return its sequence number."""
+        with self.lock:
+            cursor = self.db.execute(
+                "insert into outbox (action, args, created, attempts) values (?, ?, ?, 0)",
+                (action, json.dumps(args), time.time()))
+            self.db.commit()
+            return cursor.lastrowid
+
+    def outbox(self):
+        """Get the actions in the outbox, oldest first."""
+        with self.lock:
+            rows = self.db.execute(
+                "select seq, action, args, attempts, error from outbox order by seq").fetchall()
+        return [OutboxItem(seq, action, json.loads(args), attempts, error)
+                for seq, action, args, attempts, error in rows]
+
+    def dequeue(self, seq):
+        """Remove an action from the outbox. Return True if it was there."""
+        with self.lock:
+            cursor = self.db.execute("delete from outbox where seq = ?", (seq,))
+            self.db.commit()
+            return cursor.rowcount > 0
+
+    def failed(self, seq, error):
+        """Record a failed attempt to send an action."""
+        with self.lock:
+            self.db.execute("update outbox set attempts = attempts + 1, error = ? where seq = ?",
+                            (error, seq))
+            self.db.commit()
+
+    def retry(self):
+        """Reset the attempts of all actions in the outbox."""
+        with self.lock:
+            self.db.execute("update outbox set attempts = 0")
+            self.db.commit()
+
+    def clear(self):
+        """Remove everything."""
+        with self.lock:
+            self.db.execute("delete from posts")
+            self.db.execute("delete from streams")
+            self.db.execute("delete from renders")
+            self.db.commit()
+
+    def get_render(self, key):
+        """Get the pager output stored for a key, or None."""
+        with self.lock:
+            row = self.db.execute("select output from renders where key = ?", (key,)).fetchone()
+            if row == None:
+                return None
+            self.db.execute("update renders set used = ? where key = ?", (time.time(), key))
+            self.db.commit()
+        return row[0]
+
+    def put_render(self, key, output, max_entries):
+        """Store pager output and forget the least recently used ones."""
+        with self.lock:
+            self.db.execute("replace into renders values (?, ?, ?)", (key, output, time.time()))
+            self.db.execute("""delete from renders where key not in (
+                select key from renders order by used desc limit ?)""", (max_entries,))
+            self.db.commit()
+
 class DiasporaClient(cmd.Cmd):
 
     prompt = "\x1b[38;5;255m" + "> " + "\x1b[0m"
@@ -111,27 +1041,119 @@ class DiasporaClient(cmd.Cmd):
     editor = None
 
     connection = None
+    login_pending = False # log in when the connection is first needed
+    connect_lock = threading.Lock()
+    reauthenticating = threading.local() # active while this thread logs in again
+    reauthenticate_lock = threading.Lock()
+    offline = False
+    timings = None # list of (phase, seconds) for --profile-startup
+    last_mark = _START
+    batch = False # no pager, listings are written as JSON Lines
+    json_output = sys.stdout
+    status = _EXIT_OK
     notifications = []
-    home = None
+    watcher = None
+    min_watch_interval = 30 # seconds; don't keep the pod busy
+    flusher = None # event to wake up the thread sending the outbox
+    sending = set() # sequence numbers of the outbox items being sent
+    outbox_lock = threading.Condition() # claim and cancel items, notified when a batch is done
+    replaced = {} # undo entries replaced after 'undo' took them off the stack
+    max_attempts = 5
+    home_index = PostIndex() # the posts of the home stream
+    home_pages = None # generator for older pages of the home stream
     numbers_refer_to = None
     last_number = None
     post = None
-    post_cache = {} # key is self.post.uid, and notification.id
+    notes_index = None
+
+    # the posts and comments we have seen, for the 'search' command
+    search_index = SearchIndex()
+    search_info = {} # key is the post id, value is (authors, times)
+    search_loaded = False # whether the disk cache has been indexed
+    search_results = []
+    # key is str(self.post.id), and str(notification.about())
+    post_cache = LRUCache(max_entries = 1000, max_bytes = 20 * 1024 * 1024, sizeof = post_size)
+    store = None
+    cache_ttl = 3600
     last_comments = None
 
-    undo = []
-
-
-    # dict mapping user ids to usernames
+    undo = [] # commands, or lists of commands undone together
+    undo_group = None # list collecting the undo entries of a bulk action
+    undo_depth = 0 # of nested groups; undoing a group collects its undo entries, too
+    undo_lock = threading.Lock()
+
+    # pager output, keyed by item, content hash, pager and terminal width
+    render_cache = LRUCache(max_entries = 200, max_bytes = 5 * 1024 * 1024, sizeof = len)
+    persist_renders = False # also keep it in the disk cache
+
+    # how we talk to the pod
+    timeout = 30 # seconds
+    retries = 3 # for GET requests
+    backoff = 0.5 # seconds before the first retry, doubling every time
+    pool_size = 10 # keep-alive connections
+    scheduler = Scheduler() # rate limit, priorities and coalescing
+
+    # number of concurrent requests when fetching many things at once
+    workers = 4
+    executor = None
+    prefetching = {} # key is the post id, value is the future
+    speculations = {} # the part of prefetching started by 'show'
+
+    # dict mapping user ids to usernames, also kept in the disk cache
     users = {}
-
-    def get_username(self, guid):
-        if guid in self.users:
-            return self.users[guid]
-        else:
-            user = diaspy.people.User(connection = self.connection, guid = guid)
-            self.users[guid] = user.handle()
-            return self.users[guid]
+    users_ttl = 30 * 24 * 60 * 60
+    user_hits = 0 # found in memory or on disk
+    user_misses = 0 # asked the pod
+
+    stats = Stats()
+    depth = 0 # of nested onecmd calls; only the outermost command is recorded
+
+    job = None # the slow command running
+    finished = [] # jobs that finished in the background
+    job_lock = threading.Lock()
+    cancel = threading.Event() # set by Ctrl-C; slow commands stop loading
+
+    def get_usernames(self, guids):
+        """Return a dict mapping user ids to usernames.
+Usernames we don't know are looked up in the disk cache, and
+the rest is fetched from the pod concurrently."""
+        unknown = set(guid for guid in guids if guid not in self.users)
+        if unknown:
+            self.users.update(self.get_store().get_users(unknown, self.users_ttl))
+            unknown = [guid for guid in unknown if guid not in self.users]
+        self.user_misses += len(unknown)
+        self.user_hits += len(set(guids)) - len(unknown)
+        if unknown and self.online(quiet = True):
+            def fetch(guid):
+                # just the profile, not the person's posts
+                user = diaspy.people.User(connection = self.connection, guid = guid, fetch = None)
+                user.fetchguid(fetch_stream = False)
+                return user.handle()
+            found = {}
+            with futures.ThreadPoolExecutor(
+                    max_workers = self.workers, initializer = self.scheduler.set_priority,
+                    initargs = (self.scheduler.priority(),)) as executor:
+                pending = {executor.submit(fetch, guid): guid for guid in unknown}
+                for future in futures.as_completed(pending):
+                    try:
+                        found[pending[future]] = future.result()
+                    except Exception as e:
+                        print("Cannot find user %s: %s" % (pending[future], e))
+            self.users.update(found)
+            self.get_store().put_users(found)
+        return {guid: self.users[guid] for guid in guids if guid in self.users}
+
+    def learn_usernames(self, post):
+        """Remember the usernames of the authors of a post and its comments."""
+        found = {}
+        for record in itertools.chain([post], post.comments):
+            guid = record.author_guid
+            handle = record.handle
+            if guid and handle and self.users.get(guid) != handle:
+                found[guid] = handle
+        if found:
+            self.users.update(found)
+            self.get_store().put_users(found)
 
     def do_intro(self, line):
         """Start here."""
@@ -162,7 +1184,82 @@ enter a number to select the corresponding item.
         print("Pod:      %s" % self.pod)
         print("Pager:    %s" % self.pager)
         print("Editor:   %s" % self.editor)
-        print("Cache:    %s posts" % len(self.post_cache))
+        print("Cache:    %s" % self.post_cache.stats())
+        print("Disk:     %s posts, TTL %ds" % (len(self.get_store()), self.cache_ttl))
+        print("Users:    %s known" % len(self.users))
+
+    def get_store(self):
+        """Get the disk cache, opening it if necessary."""
+        if self.store == None:
+            self.store = PostStore(get_cache_file(), self.cache_ttl)
+        return self.store
+
+    def do_cache(self, line):
+        """Show or configure the disk cache.
+Use 'cache ttl' and a number of seconds to set how long cached posts
+are used without checking with the pod again (the default is 3600).
+Use 'cache clear' to empty the disk cache.
+Use 'cache entries' and a number to limit the number of posts kept in
+memory (the default is 1000), and 'cache memory' and a number of KiB
+to limit the memory they use (the default is 20480).
+Use 'cache renders' and a number to limit how many pager outputs are
+kept (the default is 200), and 'cache renders on' to keep them in the
+disk cache, too ('cache renders off' is the default)."""
+        words = line.strip().split()
+        if not words:
+            print("Memory cache: %s" % self.post_cache.stats())
+            print("Limits: %d entries, %d KiB" % (self.post_cache.max_entries,
+                                                 self.post_cache.max_bytes // 1024))
+            print("Disk cache: %s" % get_cache_file())
+            print("%d posts, TTL %ds" % (len(self.get_store()), self.cache_ttl))
+            print("Pager output: %s%s" % (self.render_cache.stats(),
+                                          ", also on disk" if self.persist_renders else ""))
+        elif words[0] == "renders" and len(words) == 2:
+            if words[1] in ["on", "off"]:
+                self.persist_renders = words[1] == "on"
+                print("Pager output is %skept in the disk cache." % ("" if self.persist_renders else "not "))
+                return
+            try:
+                self.render_cache.max_entries = int(words[1])
+            except ValueError:
+                print("Use a number, 'on' or 'off'.")
+                return
+            self.render_cache.shrink()
+            print("Pager output limit set: %d" % self.render_cache.max_entries)
+        elif words[0] in ["entries", "memory"] and len(words) == 2:
+            try:
+                n = int(words[1])
+            except ValueError:
+                print("The limit must be a number.")
+                return
+            if words[0] == "entries":
+                self.post_cache.max_entries = n
+                print("Memory cache limit set: %d entries" % n)
+            else:
+                self.post_cache.max_bytes = n * 1024
+                print("Memory cache limit set: %d KiB" % n)
+            self.post_cache.shrink()
+        elif words[0] == "ttl" and len(words) == 2:
+            try:
+                self.cache_ttl = int(words[1])
+            except ValueError:
+                print("The TTL must be a number of seconds.")
+                return
+            self.get_store().ttl = self.cache_ttl
+            print("Cache TTL set: %ds" % self.cache_ttl)
+        elif words[0] == "clear":
+            self.get_store().clear()
+            self.post_cache.clear()
+            self.render_cache.clear()
+            print("Cache cleared.")
+        else:
+            print("The 'cache' command takes one of the following arguments:")
+            print("- 'ttl' and a number of seconds")
+            print("- 'clear' empties the disk cache")
+            print("- 'entries' and the maximum number of posts in memory")
+            print("- 'memory' and the maximum KiB used by posts in memory")
+            print("- 'renders' and the maximum number of pager outputs kept")
+            print("- 'renders on' or 'renders off' to keep them on disk, or not")
 
     def do_password(self, password):
         """Set the password."""
@@ -228,6 +1325,310 @@ enter a number to select the corresponding item.
             else:
                 print("No changes made, %s left unchanged" % rcfile)
 
+    def online(self, quiet = False):
+        """Return True if we can talk to the pod.
+Otherwise, explain why not unless quiet is set."""
+        if self.connection == None and self.login_pending and not self.offline:
+            self.connect()
+        if self.connection != None and not self.offline:
+            return True
+        if quiet:
+            return False
+        self.status = _EXIT_OFFLINE
+        if self.offline:
+            print("You are offline. Use 'offline off' to go online.")
+        else:
+            print("Use the 'login' command, first.")
+        return False
+
+    def announce(self, message):
+        """Print a message from a background thread and redraw the prompt."""
+        print("\n" + message)
+        print(self.prompt, end = "", flush = True)
+
+    def do_offline(self, line):
+        """Go offline, or go online again using 'offline off'.
+When offline, posts, comments and notifications are read from the
+disk cache. Comments, posts and deletions are always put into the
+outbox and sent in the background once we're online."""
+        if line in ["", "on"]:
+            self.offline = True
+            print("You are offline.")
+        elif line == "off":
+            self.offline = False
+            print("You are online.")
+            if self.get_store().outbox():
+                self.wake_flusher()
+        else:
+            print("The 'offline' command takes one of the following arguments:")
+            print("- 'on' to go offline (the default)")
+            print("- 'off' to go online")
+
+    def do_outbox(self, line):
+        """List the comments, posts and deletions waiting to be sent.
+Use 'outbox cancel' and a number to remove an item.
+Use 'outbox retry' to try sending the items that failed again."""
+        words = line.strip().split()
+        if not words:
+            items = self.get_store().outbox()
+            if not items:
+                print("The outbox is empty.")
+                return
+            for item in items:
+                print("%2d. %s" % (item.seq, item))
+                if item.error:
+                    print("    %d failed attempt%s: %s" % (item.attempts, "s" if item.attempts != 1 else "", item.error))
+            if not self.online(quiet = True):
+                print("These will be sent once you're online.")
+        elif words[0] == "cancel" and len(words) == 2:
+            try:
+                seq = int(words[1])
+            except ValueError:
+                print("Cancelling requires the number of an item in the outbox.")
+                return
+            self.dequeue(seq)
+        elif words[0] == "retry":
+            self.get_store().retry()
+            self.wake_flusher()
+            print("Trying again.")
+        else:
+            print("The 'outbox' command takes one of the following arguments:")
+            print("- 'cancel' and a number removes an item from the outbox")
+            print("- 'retry' tries to send failed items again")
+
+    def dequeue(self, seq, wait = False):
+        """Remove an item from the outbox and undo the changes to the caches.
+If the item is being sent, and wait is set, wait until it has been sent
+and undo it instead; that is what 'undo' needs."""
+        with self.outbox_lock:
+            while wait and seq in self.sending:
+                self.outbox_lock.wait()
+            if seq in self.sending:
+                print("This is being sent right now.")
+                return
+            items = [item for item in self.get_store().outbox() if item.seq == seq]
+            cancelled = items and self.get_store().dequeue(seq)
+        if cancelled:
+            self.rollback(items[0])
+            print("Cancelled.")
+            return
+        with self.undo_lock:
+            command = self.replaced.pop("outbox cancel %d" % seq, None)
+        if command == None:
+            print("There is no such item in the outbox.")
+        elif command.startswith("#"):
+            print(command[1:].strip())
+        else:
+            self.onecmd(command)
+
+    def enqueue(self, action, **args):
+        """Put an action into the outbox and have it sent in the background.
+The undo stack gets an entry to cancel it; once the action has been
+sent, that entry is replaced by one that undoes it, if possible."""
+        seq = self.get_store().enqueue(action, args)
+        self.push_undo("outbox cancel %d" % seq)
+        if self.undo_group == None:
+            self.wake_flusher() # otherwise, once the bulk action is queued
+        return seq
+
+    def push_undo(self, command):
+        """Put a command on the undo stack, or into the group being collected."""
+        with self.undo_lock:
+            if self.undo_group != None:
+                self.undo_group.append(command)
+            else:
+                self.undo.append(command)
+
+    def start_group(self):
+        """Collect the undo entries of a bulk action, so that a single
+'undo' undoes all of it. Groups may be nested."""
+        with self.undo_lock:
+            self.undo_depth += 1
+            if self.undo_group == None:
+                self.undo_group = []
+
+    def end_group(self):
+        """Put the undo entries collected on the undo stack as one entry,
+once the outermost group ends, and send what the group queued."""
+        with self.undo_lock:
+            self.undo_depth -= 1
+            if self.undo_depth > 0:
+                return
+            group = self.undo_group
+            self.undo_group = None
+            if group:
+                self.undo.append(group)
+        if any(command.startswith("outbox cancel") for command in group):
+            self.wake_flusher()
+
+    def wake_flusher(self):
+        """Start or wake up the thread sending the outbox."""
+        if self.flusher == None:
+            self.flusher = threading.Event()
+            threading.Thread(target = self.flush_outbox, daemon = True).start()
+        self.flusher.set()
+
+    def flush_outbox(self):
+        """Send the items in the outbox, oldest first. If sending fails, try
+again later, waiting longer every time, and give up after a few
+attempts. This runs in a background thread."""
+        delay = None
+        while True:
+            self.flusher.wait(delay)
+            self.flusher.clear()
+            delay = None
+            while self.online(quiet = True):
+                # claim the items, so that they cannot be cancelled while we send them
+                with self.outbox_lock:
+                    items = [item for item in self.get_store().outbox() if item.attempts < self.max_attempts]
+                    if not items:
+                        break
+                    batch = items[:1]
+                    while (len(batch) < len(items) and batch[0].action in _PARALLEL_ACTIONS
+                           and items[len(batch)].action in _PARALLEL_ACTIONS):
+                        batch.append(items[len(batch)])
+                    self.sending = set(item.seq for item in batch)
+                try:
+                    failed = self.send_batch(batch)
+                finally:
+                    with self.outbox_lock:
+                        self.sending = set()
+                        self.outbox_lock.notify_all()
+                if failed:
+                    delay = min(2 ** (min(item.attempts for item in failed) + 1), 300)
+                    break
+
+    def send_batch(self, items):
+        """Send items from the outbox using the workers. Return the items
+that failed and should be tried again later."""
+        failed = []
+        sent = 0
+        with futures.ThreadPoolExecutor(
+                max_workers = min(self.workers, len(items)), initializer = self.scheduler.set_priority,
+                initargs = (self.scheduler.priority(),)) as executor:
+            pending = {executor.submit(self.send, item): item for item in items}
+            for future in futures.as_completed(pending):
+                item = pending[future]
+                try:
+                    future.result()
+                    self.get_store().dequeue(item.seq)
+                    sent += 1
+                except Exception as e:
+                    self.get_store().failed(item.seq, str(e))
+                    if item.attempts + 1 >= self.max_attempts:
+                        self.announce("Giving up on %s: %s\nUse 'outbox retry' to try again." % (item, e))
+                    else:
+                        failed.append(item)
+        if len(items) > 1:
+            self.announce("Sent %d of %d. Use 'outbox' to see the rest." % (sent, len(items))
+                          if sent < len(items) else "Sent %d." % sent)
+        return failed
+
+    def send(self, item):
+        """Send an item from the outbox to the pod."""
+        undo = "outbox cancel %d" % item.seq
+        if item.action == "comment":
+            post = self.get_post(item.args["post"])
+            response = self.write("post", "posts/%s/comments" % post.id, 201,
+                                  "could not comment on post %s" % post.id,
+                                  data = {"text": item.args["text"]})
+            comment = CommentRecord(response.json())
+            post.comments.add(comment)
+            update_comment_count(post)
+            self.get_store().put(post)
+            self.index(post)
+            self.replace_undo(undo, "delete comment %s from %s" % (comment.id, post.id))
+            self.announce("Comment posted.")
+        elif item.action == "post":
+            # like diaspy's Stream.post, without fetching the post again
+            response = self.write("post", "status_messages", 201, "could not post",
+                                  data = json.dumps({"aspect_ids": "public", "status_message": {
+                                      "text": item.args["text"], "provider_display_name": ""}}),
+                                  headers = {"content-type": "application/json"})
+            post = self.post_from_data(response.json(), [])
+            self.remember(post)
+            self.replace_undo(undo, "delete post %s" % post.id)
+            self.announce("Posted. Use 'home reload' to see it.")
+        elif item.action == "delete post":
+            self.write("delete", "posts/%s" % item.args["post"], 204,
+                       "could not delete post %s" % item.args["post"])
+            self.replace_undo(undo, "# Post %s was deleted on the pod and cannot be restored."
+                              % item.args["post"])
+        elif item.action == "delete comment":
+            self.write("delete", "posts/%s/comments/%s" % (item.args["post"], item.args["comment"]),
+                       204, "could not delete comment %s" % item.args["comment"])
+            self.replace_undo(undo, "# Comment %s was deleted on the pod and cannot be restored."
+                              % item.args["comment"])
+        elif item.action == "read notification":
+            # like diaspy's Notification.mark, without needing the notification
+            self.write("put", "notifications/%s" % item.args["notification"], 200,
+                       "could not mark notification %s" % item.args["notification"],
+                       params = {"set_unread": json.dumps(item.args["unread"])})
+            self.replace_undo(undo, "notifications %s id %s" % (
+                "read" if item.args["unread"] else "unread", item.args["notification"]))
+
+    def rollback(self, item):
+        """Undo the changes to the caches made when a deletion or a
+notification mark was queued, after it was cancelled."""
+        if item.action == "delete post" and item.args.get("data"):
+            post = self.post_from_data(item.args["data"], item.args["comments"])
+            self.post_cache[item.args["post"]] = post
+            self.get_store().put(post, item.args.get("etag"))
+            self.index(post)
+            if item.args.get("home"):
+                self.home_index.add(post)
+        elif item.action == "delete comment" and item.args.get("data"):
+            post = self.post_cache.get(item.args["post"])
+            entry = None if post else self.get_store().get(item.args["post"])
+            if entry:
+                post = self.post_from_data(entry.data, entry.comments)
+            if post:
+                post.comments.insert(CommentRecord(item.args["data"]))
+                update_comment_count(post)
+                self.get_store().put(post)
+                self.index(post)
+        elif item.action == "read notification":
+            for notification in self.notifications:
+                if str(notification.id) == item.args["notification"]:
+                    notification.unread = not item.args["unread"]
+                    notification._data["unread"] = not item.args["unread"]
+                    self.get_store().put_notifications(self.notifications)
+                    break
+
+    def replace_undo(self, old, new):
+        """Replace an entry on the undo stack. The entry may be part of a
+group, or of the group still being collected. Entries are never
+removed, so that 'undo' cannot fall through to older entries; if an
+action cannot be undone, the new entry is a comment starting with '#'
+that 'undo' prints. If 'undo' already took the entry off the stack, it
+is waiting for the item to be sent and will find the new entry in
+self.replaced."""
+        with self.undo_lock:
+            for entries in ([self.undo, self.undo_group or []]
+                            + [entry for entry in self.undo if isinstance(entry, list)]):
+                if old in entries:
+                    entries[entries.index(old)] = new
+                    break
+            else:
+                self.replaced[old] = new
+
+    def write(self, method, path, status, error, headers = {}, **args):
+        """Send a request that changes something on the pod and return the
+response. This is what diaspy's Post does, but the caches only keep
+records, and diaspy fetches a new CSRF token for every request; we use
+the one we have and only fetch a new one if the pod refuses it. Raise
+a DiaspyError unless the pod answers with the status given."""
+        headers = dict(headers, accept = "application/json")
+        for attempt in range(2):
+            headers["X-CSRF-Token"] = self.connection._token
+            response = getattr(self.connection, method)(path, headers = headers, **args)
+            if response.status_code != 422 or attempt > 0:
+                break
+            self.connection.get_token() # the token is no longer valid
+        if response.status_code != status:
+            raise diaspy.errors.DiaspyError("%d: %s" % (response.status_code, error))
+        return response
+
     def do_login(self, line):
         """Login."""
         if line != "":
@@ -237,14 +1638,352 @@ enter a number to select the corresponding item.
         elif self.password == None:
             print("Use the 'password' command.")
         else:
+            self.connection = None
+            self.login_pending = True
+            if load_session(self.account()):
+                print("Using the saved session.")
+            else:
+                self.connect()
+
+    def do_logout(self, line):
+        """Forget the saved session.
+The next 'login' command will use the password again."""
+        forget_session()
+        self.connection = None
+        self.login_pending = False
+        print("Logged out.")
+
+    def account(self):
+        """Return username@pod, identifying the saved session."""
+        return "%s@%s" % (self.username, self.pod)
+
+    def pod_url(self):
+        """Return the pod URL. Use https unless the pod names a scheme."""
+        return self.pod if "://" in self.pod else "https://%s" % self.pod
+
+    def connect(self):
+        """Set up the connection, reusing the saved session if possible.
+Only log in if there is no saved session."""
+        with self.connect_lock:
+            if self.connection != None or not self.login_pending:
+                return
+            self.login_pending = False
             print("Setting up a connection...")
-            self.connection = diaspy.connection.Connection(
-                pod = "https://%s" % self.pod, username = self.username, password = self.password)
+            connection = diaspy.connection.Connection(
+                pod = self.pod_url(), username = self.username, password = self.password)
+            self.install_transport(connection._session)
+            session = load_session(self.account())
+            if session:
+                for cookie in session["cookies"]:
+                    connection._session.cookies.set(
+                        cookie["name"], cookie["value"],
+                        domain = cookie["domain"], path = cookie["path"])
+                connection._token = session["token"]
+            else:
+                try:
+                    print("Logging in...")
+                    connection.login()
+                    connection.get_token() # the one from before logging in is no longer valid
+                except diaspy.errors.LoginError:
+                    print("Login failed.")
+                    self.status = _EXIT_LOGIN
+                    return
+                save_session(self.account(), connection._session.cookies, connection._token)
+            connection._session.hooks["response"].append(self.reauthenticate)
+            self.connection = connection
+        if self.get_store().outbox():
+            self.wake_flusher()
+
+    def install_transport(self, session):
+        """Use a pool of keep-alive connections, ask for compressed
+responses, time out, and retry GET requests that failed. Requests go
+through the scheduler; if the pod says we're sending too much, wait as
+long as it asks and try again. Identical GET requests are coalesced."""
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections = 1, pool_maxsize = max(self.pool_size, self.workers))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["Accept-Encoding"] = "gzip, deflate"
+        if hasattr(session, "send_request"):
+            return
+        session.send_request = session.request
+        def request(method, url, **kwargs):
+            if kwargs.get("timeout") == None:
+                kwargs["timeout"] = self.timeout
+            ticket = self.scheduler.ticket()
+            def send():
+                attempt = 0
+                while True:
+                    retry = method.upper() == "GET" and attempt < self.retries
+                    self.scheduler.acquire(ticket)
+                    try:
+                        response = session.send_request(method, url, **kwargs)
+                        self.stats.add("http requests", 1)
+                        self.stats.add("http bytes", len(response.content))
+                        if response.status_code == 429:
+                            # the pod didn't do anything, so any request may be repeated
+                            self.scheduler.pause(retry_after(response, self.backoff * 2 ** attempt))
+                            if attempt >= self.retries:
+                                return response
+                            attempt += 1
+                            continue
+                        if not retry or response.status_code not in (502, 503, 504):
+                            return response
+                    except (requests.ConnectionError, requests.Timeout):
+                        if not retry:
+                            raise
+                    # full jitter, so that the workers don't retry in lockstep
+                    time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+                    attempt += 1
+            if method.upper() != "GET":
+                return send()
+            key = repr((url, kwargs.get("params"), kwargs.get("headers")))
+            return self.scheduler.coalesce(key, ticket, send)
+        session.request = request
+
+    def do_network(self, line):
+        """Show or configure how we talk to the pod.
+Use 'network timeout' and a number of seconds to set how long to wait
+for the pod (the default is 30).
+Use 'network retries' and a number to set how often failed requests
+for posts, comments and the like are repeated (the default is 3).
+Use 'network backoff' and a number of seconds to set how long to wait
+before the first retry; the wait doubles every time (the default is 0.5).
+Use 'network pool' and a number to set how many connections to the pod
+are kept open (the default is 10).
+Use 'network rate' and a number to set how many requests per second
+may be sent on average (the default is 10; 0 means no limit), and
+'network burst' and a number to set how many may be sent at once
+(the default is 20). If the pod says we're sending too much, we wait
+as long as it asks."""
+        words = line.strip().split()
+        settings = {"timeout": float, "retries": int, "backoff": float, "pool": int,
+                    "rate": float, "burst": int}
+        if not words:
+            print("Timeout: %gs" % self.timeout)
+            print("Retries: %d, starting after %gs" % (self.retries, self.backoff))
+            print("Connections: %d" % self.pool_size)
+            if self.scheduler.rate:
+                print("Rate: %g requests per second, bursts of %d" % (self.scheduler.rate, self.scheduler.burst))
+            else:
+                print("Rate: no limit")
+        elif words[0] in settings and len(words) == 2:
+            try:
+                value = max(0, settings[words[0]](words[1]))
+            except ValueError:
+                print("The %s must be a number." % words[0])
+                return
+            if words[0] in ("rate", "burst"):
+                setattr(self.scheduler, words[0], value)
+            else:
+                setattr(self, "pool_size" if words[0] == "pool" else words[0], value)
+            if words[0] == "pool" and self.connection:
+                self.install_transport(self.connection._session)
+            print("Network %s set: %g" % (words[0], value))
+        else:
+            print("The 'network' command takes one of the following arguments:")
+            print("- 'timeout' and a number of seconds")
+            print("- 'retries' and a number")
+            print("- 'backoff' and a number of seconds")
+            print("- 'pool' and a number of connections")
+            print("- 'rate' and a number of requests per second")
+            print("- 'burst' and a number of requests")
+
+    def onecmd(self, line):
+        if self.depth == 0:
+            # an empty line runs the 'next' command
+            name = self.parseline(line)[0] or line.strip() or "next"
+            self.stats.start(name, line, self.counters())
+        self.depth += 1
+        try:
+            if (self.depth == 1 and not self.batch
+                and threading.current_thread() is threading.main_thread()):
+                # other commands keep the '&', e.g. at the end of a comment
+                background = line.rstrip().endswith("&")
+                command = line.rstrip().rstrip("&").rstrip() if background else line
+                command = self.expand(command)
+                if self.parseline(command)[0] in _SLOW_COMMANDS:
+                    return self.start_job(command, background)
+            return super().onecmd(line)
+        except requests.RequestException as e:
+            print("The pod did not answer: %s" % e)
+            self.status = _EXIT_ERROR
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.stats.stop(self.counters())
+
+    def expand(self, line):
+        """Return the command a line stands for: an empty line goes to the
+next post, shortcuts are expanded, and a number shows that post."""
+        words = line.split()
+        if not words:
+            return "next"
+        if words[0] in shortcuts:
+            return line.replace(words[0], shortcuts[words[0]], 1)
+        if words[0].isdigit():
+            return "show " + line.strip()
+        return line
+
+    def start_job(self, line, background):
+        """Run a slow command in a worker thread and wait for it, unless it
+should run in the background."""
+        if self.job:
+            print("Still busy with '%s'. Use 'wait' to wait for it." % self.job.line)
+            return
+        self.cancel.clear()
+        job = Job(line)
+        def work():
             try:
-                print("Logging in...")
-                self.connection.login()
-            except diaspy.errors.LoginError:
-                print("Login failed.")
+                cmd.Cmd.onecmd(self, line)
+            except requests.RequestException as e:
+                print("The pod did not answer: %s" % e)
+                self.status = _EXIT_ERROR
+            except Exception as e:
+                print("%s: %s" % (line, e))
+                self.status = _EXIT_ERROR
+            finally:
+                with self.job_lock:
+                    self.job = None
+                    self.cancel.clear()
+                    if job.detached:
+                        job.output = sys.stdout.release(job.thread)
+                        self.finished.append(job)
+                        self.announce("'%s' is done. Use 'wait' to see what it printed." % line)
+                job.done.set()
+        job.thread = threading.Thread(target = work, daemon = True)
+        self.job = job
+        job.thread.start()
+        if background:
+            self.detach(job)
+        else:
+            self.wait_for(job)
+
+    def wait_for(self, job):
+        """Wait for a job. The first Ctrl-C cancels it: it stops loading and
+shows what it has. The second one leaves it running in the background."""
+        interrupted = False
+        while not job.done.is_set():
+            try:
+                job.done.wait(0.1)
+            except KeyboardInterrupt:
+                if interrupted:
+                    print()
+                    self.detach(job)
+                    return
+                interrupted = True
+                self.cancel.set()
+                print("\nCancelling... Press Ctrl-C again to leave it running in the background.")
+
+    def detach(self, job):
+        """Hold the output of a job and let it run in the background.
+It goes on loading, and the commands typed meanwhile may fetch again."""
+        with self.job_lock:
+            if self.job is not job:
+                return # it is done
+            self.cancel.clear()
+            if not isinstance(sys.stdout, Output):
+                sys.stdout = Output(sys.stdout)
+            sys.stdout.hold(job.thread)
+            job.detached = True
+        print("Running '%s' in the background. Use 'wait' to see what it printed." % job.line)
+
+    def do_wait(self, line):
+        """Wait for the command running in the background and show what it
+printed, and show what the commands that finished in the background
+printed. While waiting, Ctrl-C cancels the command."""
+        with self.job_lock:
+            job = self.job
+            if job:
+                print(sys.stdout.release(job.thread), end = "")
+                job.detached = False
+            finished = self.finished
+            self.finished = []
+        for done in finished:
+            print(done.output, end = "")
+        if job:
+            self.wait_for(job)
+        elif not finished:
+            print("Nothing is running in the background.")
+
+    def counters(self):
+        """Return the cache counters, for the stats."""
+        return {"post cache hits": self.post_cache.hits,
+                "post cache misses": self.post_cache.misses,
+                "user hits": self.user_hits, "user misses": self.user_misses,
+                "rate limited": self.scheduler.limited, "coalesced": self.scheduler.coalesced}
+
+    def do_stats(self, line):
+        """Show how long commands took.
+For every command, show how often it ran, the median and 95th
+percentile of the time it took, the average number of requests sent
+to the pod, the KiB received and the time spent in the pager.
+Use 'stats clear' to start over.
+Use 'stats trace' and a file name to append a JSON object for every
+command to the file, and 'stats trace off' to stop."""
+        words = line.strip().split(maxsplit = 2)
+        if not words:
+            for summary in self.stats.summary():
+                print(summary)
+            print("Post cache: %.0f%% hits (%s)" % (self.post_cache.hit_rate() * 100, self.post_cache.stats()))
+            lookups = self.user_hits + self.user_misses
+            print("Usernames: %.0f%% hits (%d hits, %d misses)" % (
+                self.user_hits * 100 / lookups if lookups else 0, self.user_hits, self.user_misses))
+            print("Requests: %d coalesced, rate limited %d times, %.1fs waiting" % (
+                self.scheduler.coalesced, self.scheduler.limited, self.scheduler.waited))
+        elif words == ["clear"]:
+            self.stats.clear()
+            print("Stats cleared.")
+        elif words == ["trace", "off"]:
+            if self.stats.trace:
+                self.stats.trace.close()
+                self.stats.trace = None
+            print("Trace stopped.")
+        elif words[0] == "trace" and len(words) == 2:
+            if self.stats.trace:
+                self.stats.trace.close()
+            self.stats.trace = open(os.path.expanduser(words[1]), "a")
+            print("Tracing to %s" % words[1])
+        else:
+            print("The 'stats' command takes one of the following arguments:")
+            print("- 'clear' forgets the stats")
+            print("- 'trace' and a file name to write a trace")
+            print("- 'trace off' to stop")
+
+    def reauthenticate(self, response, *args, **kwargs):
+        """Log in again if the pod no longer accepts our session.
+Save the new session and repeat the request. Workers run this, too:
+only one of them logs in, and the others repeat their requests with
+the new session."""
+        if response.status_code != 401 or getattr(self.reauthenticating, "active", False):
+            return response
+        session = self.connection._session
+        with self.reauthenticate_lock:
+            # unless another thread logged in since this request was sent
+            current = response.request.copy()
+            current.headers.pop("Cookie", None)
+            current.prepare_cookies(session.cookies)
+            if current.headers.get("Cookie") == response.request.headers.get("Cookie"):
+                self.reauthenticating.active = True
+                try:
+                    print("The session expired. Logging in...")
+                    # diaspy forgets the password after logging in
+                    self.connection._setlogin(self.username, self.password)
+                    self.connection.login()
+                    self.connection.get_token()
+                except (diaspy.errors.DiaspyError, requests.RequestException) as e:
+                    print("Login failed: %s" % e)
+                    forget_session()
+                    return response
+                finally:
+                    self.reauthenticating.active = False
+                save_session(self.account(), session.cookies, self.connection._token)
+        request = response.request.copy()
+        request.headers.pop("Cookie", None)
+        if "x-csrf-token" in request.headers:
+            request.headers["x-csrf-token"] = self.connection._token
+        request.prepare_cookies(session.cookies)
+        return session.send(request)
 
     def do_pager(self, pager):
         """Set the pager, e.g. to 'fold -w 72'.
@@ -266,47 +2005,211 @@ The filename is appended at the end."""
     def do_notifications(self, line):
         """List notifications.
 Use 'notifications update' to fetch the latest five.
-Use 'notifications more' to fetch five more."""
+Use 'notifications more' to fetch five more.
+Use 'notifications watch' to check for new notifications in the
+background every five minutes, or give it a number of seconds (at
+least 30).
+Use 'notifications watch off' to stop.
+Use 'notifications read' or 'notifications unread' and numbers, ranges
+or 'all' to mark notifications, e.g. 'notifications read 1-20'.
+Use 'notifications read id' and notification ids to mark them by id."""
+        words = line.split()
+        if words and words[0] in ("read", "unread"):
+            self.mark_notifications(words[1:], words[0] == "unread")
+            return
+        if not self.notifications and not self.online(quiet = True):
+            self.notifications = [diaspy.models.Notification(self.connection, data)
+                                  for data in self.get_store().get_notifications()]
+            if self.notifications:
+                print("Retrieved notifications from the disk cache.")
+        if line in ["update", "more"] or line.startswith("watch"):
+            if not self.online():
+                return
+            if not isinstance(self.notifications, diaspy.notifications.Notifications):
+                self.notifications = []
         if not self.notifications:
-            if self.connection == None:
-                print("Use the 'login' command, first.")
+            if not self.online():
                 return
             self.notifications = diaspy.notifications.Notifications(self.connection)
+            self.get_store().put_notifications(self.notifications)
+            self.prefetch([str(notification.about()) for notification in self.notifications])
         if line == "":
             print("Redisplaying the notifications in the cache.")
             print("Use 'notifications update' to load new ones.")
         elif line == "update":
             self.notifications.update()
+            self.get_store().put_notifications(self.notifications)
+            self.prefetch([str(notification.about()) for notification in self.notifications])
         elif line == "more":
             self.notifications.more()
+            self.get_store().put_notifications(self.notifications)
+            self.prefetch([str(notification.about()) for notification in self.notifications])
+        elif re.fullmatch("watch( \\d+| off)?", line):
+            interval = int(line[6:]) if line[6:].isdigit() else 300
+            if interval < self.min_watch_interval:
+                print("Watching takes at least %d seconds between checks." % self.min_watch_interval)
+                return
+            if self.watcher:
+                self.watcher.set()
+                self.watcher = None
+            if line == "watch off":
+                print("Stopped watching notifications.")
+            else:
+                self.watch(interval)
+                print("Watching notifications every %ds." % interval)
+            return
         else:
             print("The 'notifications' command only takes one of the following argument:")
             print("- 'reload' fetches the last five notifications")
             print("- 'more' fetches five earlier notifications")
+            print("- 'watch' checks for new notifications in the background")
+            print("- 'read' or 'unread' and numbers marks notifications")
             return
         # print notifications
-        if len(self.notifications) > 0:
-            for n, notification in enumerate(self.notifications):
-                if notification.unread:
-                    print(self.header("%2d. %s %s") % (n+1, notification.when(), notification))
-                else:
-                    print("%2d. %s %s" % (n+1, notification.when(), notification))
+        if len(list(self.notifications)) > 0:
+            handles = self.get_usernames([guid for notification in self.notifications
+                                          for guid in notification.who()])
+            if self.batch:
+                self.emit(self.notification_record(n, notification, handles)
+                          for n, notification in enumerate(self.notifications))
+            else:
+                self.page(self.notification_listing(self.notifications, handles), "notifications")
             print("Enter a number to select the notification.")
             self.numbers_refer_to = 'notifications'
+            self.speculate([])
         else:
             print("There are no notifications. 😢")
 
+    def mark_notifications(self, words, unread):
+        """Mark the notifications given by numbers and ranges as read or
+unread. They are marked right away and the pod is told in the
+background; a single 'undo' undoes all of it."""
+        if words and words[0] == "id":
+            # used by 'undo'; the notifications need not be loaded
+            ids = words[1:]
+            changed = [notification for notification in self.notifications
+                       if str(notification.id) in ids and notification.unread != unread]
+        else:
+            if not self.notifications:
+                print("Use the 'notifications' command to load notifications.")
+                return
+            try:
+                numbers = parse_numbers(words, len(list(self.notifications)))
+            except ValueError:
+                print("Marking notifications requires numbers, ranges or 'all'.")
+                return
+            except IndexError:
+                print("Use the 'notifications' command to find valid notification numbers.")
+                return
+            changed = [self.notifications[n-1] for n in numbers
+                       if self.notifications[n-1].unread != unread]
+            ids = [str(notification.id) for notification in changed]
+        for notification in changed:
+            notification.unread = unread
+            notification._data["unread"] = unread
+        self.start_group()
+        for id in ids:
+            self.enqueue("read notification", notification = id, unread = unread)
+        self.end_group()
+        self.get_store().put_notifications(self.notifications)
+        print("%d notification%s marked as %s." % (
+            len(ids), "s" if len(ids) != 1 else "", "unread" if unread else "read"))
+
+    def notification_listing(self, notifications, handles):
+        """Generate the text for a list of notifications.
+The handles map user ids to usernames for the people involved."""
+        for n, notification in enumerate(notifications):
+            people = ", ".join(handles[guid] for guid in notification.who() if guid in handles)
+            text = "%s (%s)" % (notification, people) if people else str(notification)
+            if notification.unread:
+                yield self.header("%2d. %s %s") % (n+1, notification.when(), text) + "\n"
+            else:
+                yield "%2d. %s %s\n" % (n+1, notification.when(), text)
+
+    def watch(self, interval):
+        """Check for new notifications in a background thread.
+If there aren't any, wait twice as long the next time, up to an hour."""
+        stop = threading.Event()
+        def run():
+            self.scheduler.set_priority(_PRIORITY_POLLING)
+            delay = interval
+            while not stop.wait(delay):
+                try:
+                    new = self.fetch_new_notifications() if self.online(quiet = True) else None
+                except Exception:
+                    new = None
+                if new and not stop.is_set():
+                    delay = interval
+                    unread = sum(1 for notification in self.notifications if notification.unread)
+                    self.announce("%d new notification%s, %d unread." % (len(new), "s" if len(new) != 1 else "", unread))
+                else:
+                    delay = min(delay * 2, max(interval, 3600))
+        self.watcher = stop
+        threading.Thread(target = run, daemon = True).start()
+
+    def fetch_new_notifications(self):
+        """Fetch the notifications newer than the newest one we have and
+add them to the front of the list. Return the new ones."""
+        known = set(notification.id for notification in self.notifications)
+        newest = max((notification.when() for notification in self.notifications), default = "")
+        new = []
+        for page in range(1, 6):
+            batch = self.notifications.get(per_page = 5, page = page)
+            found = [n for n in batch if n.id not in known and n.when() > newest]
+            new.extend(found)
+            if len(found) < 5:
+                break
+        if new:
+            self.notifications._notifications = new + list(self.notifications._notifications)
+            self.get_store().put_notifications(self.notifications)
+            if self.numbers_refer_to == 'notifications' and self.last_number:
+                self.last_number += len(new)
+            self.prefetch([str(notification.about()) for notification in new])
+        return new
+
     def do_quit(self, *args):
         """Exit jan-pona-mute."""
+        if self.executor:
+            self.executor.shutdown(wait = False, cancel_futures = True)
         print("Be safe!")
-        sys.exit()
+        sys.exit(self.status)
+
+    def mark(self, phase):
+        """Record the time spent on a phase of the startup."""
+        now = time.perf_counter()
+        if self.timings != None:
+            self.timings.append((phase, now - self.last_mark))
+        self.last_mark = now
+
+    def report_startup(self):
+        """Print the startup timings to stderr, once."""
+        if self.timings == None:
+            return
+        for phase, seconds in self.timings:
+            print("%8.1f ms  %s" % (seconds * 1000, phase), file = sys.stderr)
+        print("%8.1f ms  total" % ((time.perf_counter() - _START) * 1000), file = sys.stderr)
+        self.timings = None
+
+    def precmd(self, line):
+        self.last_mark = time.perf_counter()
+        return line
+
+    def postcmd(self, stop, line):
+        if self.timings != None:
+            self.mark(line)
+            if not self.batch and not self.cmdqueue:
+                self.report_startup()
+        return stop
 
     def emptyline(self):
         """Go to the next notification or post."""
         return self.onecmd("next")
 
     def do_previous(self, line):
-        """Go to the previous notification or post."""
+        """Go to the previous notification or post.
+In the home stream, going back from the first post loads older posts."""
+        if self.last_number == 1 and self.numbers_refer_to == 'home':
+            self.more_home()
         if self.last_number and self.last_number > 1:
             print("Previous...")
             return self.onecmd("show %d" % (self.last_number - 1))
@@ -336,7 +2239,7 @@ Use 'notifications more' to fetch five more."""
 The index number must refer to the current list of notifications
 or the home stream. If no index number is given, show the current
 post again."""
-        if not self.notifications and not self.home:
+        if not self.notifications and not self.home_index and not self.search_results:
             print("Use the 'notifications' command to load notifications.")
             return
         if line == "" and self.post == None:
@@ -346,74 +2249,432 @@ post again."""
         if line != "":
             try:
                 n = int(line.strip())
+                # fetch what comes next while this one is being read
+                self.speculate(self.upcoming(n, self.last_number))
                 if self.numbers_refer_to == 'notifications':
                     notification = self.notifications[n-1]
                     self.last_number = n; # doesn't matter if we can't load it later
-                    self.show(notification)
+                    self.show(notification, "notification %s" % notification.id)
                     if not self.load(str(notification.about())): # elsewhere, id is a string
                         return
-                elif self.numbers_refer_to == 'home':
-                    posts = sorted(self.home, key=lambda x: x.data()["created_at"])
-                    self.post = posts[n-1]
+                elif self.numbers_refer_to in ['home', 'search']:
+                    if n < 1:
+                        raise IndexError
+                    ids = self.home_index if self.numbers_refer_to == 'home' else self.search_results
+                    post = self.get_post(ids[n-1])
+                    if post == None:
+                        return
+                    self.post = post
                     self.last_number = n;
                 else:
                     print("Internal error: not sure what numbers '%s' refer to." % self.numbers_refer_to)
                     return
             except ValueError:
                 print("The 'show' command takes a notification number but '%s' is not a number" % line)
+                self.status = _EXIT_ERROR
                 return
             except IndexError:
                 print("Index too high!")
+                self.status = _EXIT_ERROR
                 return
 
+        if self.batch:
+            self.emit([self.post_record(n - 1 if n else None, self.post)])
+            return
+
         print()
         if n:
-            print(self.header("%2d. %s %s") % (n, self.post.data()["created_at"], self.post.author()))
+            print(self.header("%2d. %s %s") % (n, self.post.created_at, self.post.author))
         else:
-            print(self.header("%s %s") % (self.post.data()["created_at"], self.post.author()))
+            print(self.header("%s %s") % (self.post.created_at, self.post.author))
         print()
-        self.show(self.post)
+        self.show(self.post, "post %s" % self.post.id)
         print()
 
-        if(self.post.comments):
-            print("%d comment%s" % (len(self.post.comments), "s" if len(self.post.comments) != 1 else ""))
+        count = comment_count(self.post)
+        if count:
+            print("%d comment%s" % (count, "s" if count != 1 else ""))
             print("Use the 'comments' command to list the latest comments.")
         print("Use the 'comment' command to leave a comment.")
 
     def load(self, id):
         """Load the post belonging to the id (from a notification),
-or get it from the cache."""
-        if id in self.post_cache:
-            self.post = self.post_cache[id]
+or get it from the cache. Posts in the disk cache are used as long as
+they are fresh; stale ones are revalidated with the pod."""
+        future = self.prefetching.get(id)
+        if future:
+            try:
+                self.post = future.result()
+                print("Retrieved post from the cache.")
+                return self.post
+            except Exception:
+                pass # try again below
+        post = self.post_cache.get(id)
+        if post:
+            self.post = post
             print("Retrieved post from the cache.")
+            return self.post
+        entry = self.get_store().get(id)
+        if entry and (entry.fresh or not self.online(quiet = True)):
+            self.post = self.post_from_data(entry.data, entry.comments)
+            self.post_cache[id] = self.post
+            print("Retrieved post from the disk cache.")
+            return self.post
+        if not self.online():
+            return None
+        print("Loading...")
+        try:
+            self.post = self.fetch_post(id, entry)
+        except diaspy.errors.PostError as e:
+            print("Cannot load this post: %s" % e)
+            self.status = _EXIT_ERROR
+            return None
+        return self.post
+
+    def fetch_post(self, id, entry = None):
+        """Fetch a post from the pod and store it in the caches.
+If we have a stale disk cache entry, ask the pod whether the post
+has changed and keep the stored comments if it hasn't. If it has,
+keep the comments we know and add the new ones the pod included."""
+        headers = {"accept": "application/json"}
+        if entry and entry.etag:
+            headers["if-none-match"] = entry.etag
+        response = self.connection.get("posts/%s.json" % id, headers = headers)
+        if response.status_code == 304:
+            post = self.post_from_data(entry.data, entry.comments)
+            self.get_store().touch(post.id)
+        elif response.status_code == 200:
+            post = self.post_from_data(response.json(), [])
+            known = self.post_cache.get(str(id))
+            if known == None and entry:
+                known = self.post_from_data(entry.data, entry.comments)
+            if known:
+                self.merge_comments(post, known.comments)
+            self.get_store().put(post, response.headers.get("etag"))
+            self.learn_usernames(post)
         else:
-            print("Loading...")
+            raise diaspy.errors.PostError("%d: could not fetch post %s" % (response.status_code, id))
+        self.post_cache[str(post.id)] = post
+        self.index(post)
+        return post
+
+    def merge_comments(self, post, comments):
+        """Add the comments we knew to a post we just fetched.
+The post has the latest comments the pod included. If the comments we
+knew and the new ones add up to the number of comments, then there
+is no gap and we know them all; otherwise only the latest are kept."""
+        new = [comment for comment in post.comments if comments.get(comment.id) == None]
+        if len(comments) + len(new) == comment_count(post):
+            for comment in new:
+                comments.add(comment)
+            post.comments = comments
+
+    def get_executor(self):
+        """Get the pool of worker threads used for background fetching."""
+        if self.executor == None:
+            self.executor = futures.ThreadPoolExecutor(
+                max_workers = self.workers, initializer = self.scheduler.set_priority,
+                initargs = (_PRIORITY_PREFETCH,))
+        return self.executor
+
+    def prefetch(self, ids):
+        """Fetch the posts with these ids in the background.
+Posts that are already in the cache or on their way are skipped.
+Return a dict mapping the ids of the posts submitted to their futures."""
+        submitted = {}
+        if self.batch or self.cancel.is_set() or not self.online(quiet = True):
+            return submitted
+        for id in dict.fromkeys(ids):
+            if id in self.post_cache or id in self.prefetching:
+                continue
+            entry = self.get_store().get(id)
+            if entry and entry.fresh:
+                continue
+            future = self.get_executor().submit(self.fetch_post, id, entry)
+            self.prefetching[id] = future
+            future.add_done_callback(lambda future, id = id: self.prefetching.pop(id, None))
+            submitted[id] = future
+        return submitted
+
+    def speculate(self, ids):
+        """Prefetch the posts we'll probably show next. Earlier speculations
+for other posts are cancelled unless they are already being fetched."""
+        for id in list(self.speculations):
+            if id not in ids:
+                self.speculations.pop(id).cancel()
+        self.speculations.update(self.prefetch(ids))
+
+    def upcoming(self, n, last):
+        """Return the ids of the two posts after number n, or before it if
+we're going backwards."""
+        step = -1 if last and n < last else 1
+        numbers = [n + step, n + 2 * step]
+        if self.numbers_refer_to == 'notifications':
+            return [str(self.notifications[i-1].about()) for i in numbers
+                    if 1 <= i <= len(list(self.notifications))]
+        ids = self.home_index if self.numbers_refer_to == 'home' else self.search_results
+        return [ids[i-1] for i in numbers if 1 <= i <= len(ids)]
+
+    def do_workers(self, line):
+        """Set the number of concurrent requests used when fetching many
+things at once, e.g. posts for notifications (the default is 4)."""
+        try:
+            self.workers = max(1, int(line.strip()))
+        except ValueError:
+            print("Workers: %d" % self.workers)
+            return
+        if self.executor:
+            self.executor.shutdown(wait = False)
+            self.executor = None
+        print("Workers set: %d" % self.workers)
+
+    def get_post(self, id):
+        """Get a post from the caches, or fetch it."""
+        future = self.prefetching.get(id)
+        if future:
             try:
-                self.post = diaspy.models.Post(connection = self.connection, id = id)
-                self.post_cache[id] = self.post
-            except diaspy.errors.PostError as e:
-                print("Cannot load this post: %s" % e)
-                return None
-        return self.post
+                return future.result()
+            except Exception:
+                pass # try again below
+        post = self.post_cache.get(id)
+        if post:
+            return post
+        entry = self.get_store().get(id)
+        if entry:
+            post = self.post_from_data(entry.data, entry.comments)
+            self.post_cache[id] = post
+            return post
+        if self.cancel.is_set() or not self.online():
+            return None
+        try:
+            return self.fetch_post(id)
+        except diaspy.errors.PostError as e:
+            print("Cannot load this post: %s" % e)
+            self.status = _EXIT_ERROR
+            return None
+
+    def load_comments(self, post, start = 0):
+        """Fetch the comments of a post unless we already know the comments
+from position start on. The pod only sends all of them at once."""
+        if post.comments.has(start) or not self.online(quiet = True):
+            return
+        response = self.connection.get("posts/%s/comments.json" % post.id,
+                                       headers = {"accept": "application/json"})
+        if response.status_code != 200:
+            print("Cannot load the comments: %d" % response.status_code)
+            self.status = _EXIT_ERROR
+            return
+        post.comments.set(CommentRecord(c) for c in response.json())
+        update_comment_count(post)
+        self.remember(post)
+
+    def post_from_data(self, data, comments):
+        """Turn post and comment data from the pod or the disk cache into a
+post. Without comments, use the latest comments included in the data."""
+        return PostRecord(data, comments or embedded_comments(data))
+
+    def remember(self, post):
+        """Put a post into the memory and the disk cache."""
+        self.post_cache[str(post.id)] = post
+        self.get_store().put(post)
+        self.index(post)
+        self.learn_usernames(post)
 
     def do_reload(self, line):
-        """Reload the current post."""
+        """Reload the current post.
+Only the post is fetched, and only if it changed. New comments are
+added to the ones we know, if the pod includes them."""
         if self.post == None:
             print("Use the 'show' command to show a post, first.")
             return
+        if not self.online():
+            return
         print("Reloading...")
-        self.post = diaspy.models.Post(connection = self.connection, id = self.post.id)
-        self.post_cache[id] = self.post
-
-    def show(self, item):
-        """Show the current item."""
-        if self.pager:
-            try:
-                subprocess.run(self.pager.split(), input = str(item), text = True)
-            except FileNotFoundError:
-                print("Could not execute '%s'. Use the 'pager' command to change the pager." % self.pager)
-        else:
-            print(str(item))
+        count = comment_count(self.post)
+        try:
+            self.post = self.fetch_post(self.post.id, self.get_store().get(str(self.post.id)))
+            new = comment_count(self.post) - count
+            if new > 0:
+                print("%d new comment%s" % (new, "s" if new != 1 else ""))
+            else:
+                print("No new comments.")
+        except diaspy.errors.PostError as e:
+            print("Cannot reload this post: %s" % e)
+            self.status = _EXIT_ERROR
+
+    def show(self, item, name = None):
+        """Show the current item. The name identifies it in the render cache."""
+        self.page([str(item) + "\n"], name)
+
+    def page(self, chunks, name = "listing"):
+        """Send the text chunks to a single pager process, or print them.
+The chunks may come from a generator: the pager gets each chunk as
+soon as it has been produced. If the pager just formats the text,
+like mdcat or fold, and the text is known in advance, its output is
+cached and the same text is shown again without running the pager."""
+        if not self.pager or self.batch or self.in_background():
+            for chunk in chunks:
+                sys.stdout.write(chunk)
+            sys.stdout.flush()
+            return
+        if os.path.basename(self.pager.split()[0]) not in _INTERACTIVE_PAGERS:
+            self.page_cached(chunks, name)
+            return
+        started = time.perf_counter()
+        try:
+            process = subprocess.Popen(self.pager.split(), stdin = subprocess.PIPE, text = True)
+        except FileNotFoundError:
+            print("Could not execute '%s'. Use the 'pager' command to change the pager." % self.pager)
+            return
+        # time spent producing the chunks doesn't count as pager time
+        waited = time.perf_counter() - started
+        try:
+            for chunk in chunks:
+                started = time.perf_counter()
+                process.stdin.write(chunk)
+                process.stdin.flush()
+                waited += time.perf_counter() - started
+            started = time.perf_counter()
+            process.stdin.close()
+        except BrokenPipeError:
+            started = time.perf_counter() # the user quit the pager
+        process.wait()
+        self.stats.add("pager", waited + time.perf_counter() - started)
+
+    def in_background(self):
+        """Return True if this is a job whose output is being held."""
+        return isinstance(sys.stdout, Output) and threading.current_thread() in sys.stdout.held
+
+    def page_cached(self, chunks, name):
+        """Show the output of the pager for the text chunks, using the render
+cache. If the chunks are a list, a cached output is shown without
+running the pager, and the output is cached once the text is complete.
+Otherwise the output is only shown as it comes: the text isn't known
+in advance, so its output could never be found in the cache."""
+        if isinstance(chunks, list):
+            key = self.render_key("".join(chunks), name)
+            output = self.render_cache.get(key)
+            if output == None and self.persist_renders:
+                output = self.get_store().get_render(key)
+            if output != None:
+                self.render_cache[key] = output
+                sys.stdout.write(output)
+                sys.stdout.flush()
+                return
+        try:
+            text, output, seconds = self.render(chunks)
+        except FileNotFoundError:
+            print("Could not execute '%s'. Use the 'pager' command to change the pager." % self.pager)
+            return
+        self.stats.add("pager", seconds)
+        if text == None or not isinstance(chunks, list):
+            return
+        key = self.render_key(text, name)
+        self.render_cache[key] = output
+        if self.persist_renders:
+            self.get_store().put_render(key, output, self.render_cache.max_entries)
+
+    def render_key(self, text, name):
+        """The render cache key for the output of the pager for a text."""
+        return "%s %s %s %d" % (name, hashlib.sha1(text.encode()).hexdigest(), self.pager,
+                                shutil.get_terminal_size().columns)
+
+    def render(self, chunks):
+        """Run the pager on the text chunks and write its output as it
+comes. The pager writes to a pseudo terminal of the same width as
+ours, so it formats the text just as if it were writing to the screen.
+Return the text, the output, and the seconds spent on the pager, not
+counting the time spent producing the chunks. If the pager quit early,
+the text is None."""
+        started = time.perf_counter()
+        (master, slave) = pty.openpty()
+        size = shutil.get_terminal_size()
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", size.lines, size.columns, 0, 0))
+        attributes = termios.tcgetattr(slave)
+        attributes[1] &= ~termios.ONLCR # don't turn newlines into CR LF
+        termios.tcsetattr(slave, termios.TCSANOW, attributes)
+        try:
+            process = subprocess.Popen(self.pager.split(), stdin = subprocess.PIPE,
+                                       stdout = slave, stderr = slave)
+        except FileNotFoundError:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        output = []
+        def read():
+            decoder = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+            while True:
+                try:
+                    data = os.read(master, 65536)
+                except OSError: # the pager is done
+                    break
+                if not data:
+                    break
+                output.append(decoder.decode(data))
+                sys.stdout.write(output[-1])
+                sys.stdout.flush()
+            rest = decoder.decode(b"", final = True)
+            if rest:
+                output.append(rest)
+                sys.stdout.write(rest)
+        reader = threading.Thread(target = read, daemon = True)
+        reader.start()
+        text = []
+        waited = time.perf_counter() - started
+        try:
+            for chunk in chunks:
+                text.append(chunk)
+                started = time.perf_counter()
+                process.stdin.write(chunk.encode())
+                process.stdin.flush()
+                waited += time.perf_counter() - started
+            started = time.perf_counter()
+            process.stdin.close()
+        except BrokenPipeError:
+            started = time.perf_counter() # the pager quit; show what it wrote
+            text = None
+        process.wait()
+        reader.join()
+        os.close(master)
+        sys.stdout.flush()
+        if text != None:
+            text = "".join(text)
+        return text, "".join(output), waited + time.perf_counter() - started
+
+    def emit(self, records):
+        """Write records as JSON Lines, for batch mode."""
+        for record in records:
+            self.json_output.write(json.dumps(record, ensure_ascii = False) + "\n")
+        self.json_output.flush()
+
+    def post_record(self, n, post):
+        """A dict describing a post, for batch mode."""
+        return {"type": "post", "number": n + 1 if n != None else None,
+                "id": post.id, "guid": post.guid, "author": post.author, "handle": post.handle,
+                "created_at": post.created_at, "text": post.text,
+                "comments": comment_count(post)}
+
+    def comment_record(self, n, comment):
+        """A dict describing a comment of the current post, for batch mode."""
+        return {"type": "comment", "number": n + 1, "id": comment.id,
+                "guid": comment.guid, "post": self.post.id,
+                "author": comment.author, "handle": comment.handle,
+                "created_at": comment.created_at, "text": comment.text}
+
+    def notification_record(self, n, notification, handles):
+        """A dict describing a notification, for batch mode."""
+        return {"type": "notification", "number": n + 1, "id": notification.id,
+                "kind": notification.type, "unread": notification.unread,
+                "created_at": notification.when(), "text": str(notification),
+                "people": [handles.get(guid, guid) for guid in notification.who()],
+                "post": notification.about()}
+
+    def comment_listing(self, comments, start):
+        """Generate the text for a list of comments."""
+        for n, comment in enumerate(comments, start):
+            yield "\n" + self.header("%2d. %s %s") % (n+1, comment.created_at, comment.author) + "\n\n"
+            yield str(comment) + "\n"
 
     def do_comments(self, line):
         """Show the comments for the current post.
@@ -465,12 +2726,17 @@ up, use 'next' to show comments further down."""
         end = max(end, start)
         end = min(end, len(comments))
 
+        # only fetch the comments if we don't know the ones to show
+        self.load_comments(self.post, start)
+        window = comments.window(start, end)
+        start = max(start, end - len(window))
+
         if comments:
-            for n, comment in enumerate(comments[start:end], start):
-                print()
-                print(self.header("%2d. %s %s") % (n+1, comment.when(), comment.author()))
-                print()
-                self.show(comment)
+            if self.batch:
+                self.emit(self.comment_record(n, comment)
+                          for n, comment in enumerate(window, start))
+            else:
+                self.page(self.comment_listing(window, start), "comments %s" % self.post.id)
             print()
         else:
             print("There are no comments on the selected post.")
@@ -498,10 +2764,8 @@ Use the 'edit' command to edit notes."""
         if line in notes:
             print("Using note '%s'" % line)
             line = self.read_note(line)
-        comment = self.post.comment(line)
-        self.post.comments.add(comment)
-        self.undo.append("delete comment %s from %s" % (comment.id, self.post.id))
-        print("Comment posted.")
+        self.enqueue("comment", post = str(self.post.id), text = line)
+        print("Comment queued. Use the 'undo' command to undo this.")
 
     def complete_comment(self, text, line, begidx, endidx):
         """Complete on filenames of notes"""
@@ -515,81 +2779,118 @@ Use the 'edit' command to edit notes."""
         if line == "":
             print("Post what?")
             return
-        if self.home == None:
-            print("Loading...")
-            self.home = diaspy.streams.Stream(self.connection)
         notes = self.get_notes()
         if line in notes:
             print("Using note '%s'" % line)
             line = self.read_note(line)
-        self.post = self.home.post(text = line)
-        self.post_cache[self.post.id] = self.post
-        self.undo.append("delete post %s" % self.post.id)
-        print("Posted. Use the 'show' command to show it. Use the 'undo' command to undo this.")
+        self.enqueue("post", text = line)
+        print("Post queued. Use the 'undo' command to undo this.")
 
     def do_delete(self, line):
-        """Delete a comment."""
+        """Delete a post, a comment, or a note.
+Posts and comments are removed from the caches right away and the
+deletion is sent to the pod in the background; cancelling it puts
+them back.
+Use numbers and ranges to delete several comments, e.g. 'delete
+comment 3-7 9', and several names to delete several notes. A single
+'undo' undoes all of it."""
         words = line.strip().split(maxsplit = 1)
         if words:
             if words[0] == "post":
                 if len(words) > 1:
-                    print("Deleting a post takes no argument. It always deletes the selected post.")
-                    return
-                if not self.post:
+                    id = words[1]
+                elif self.post:
+                    id = str(self.post.id)
+                else:
                     print("Use the 'show' command to select a post.")
                     return
-                if self.home and self.post in self.home:
-                    self.home._stream.remove(self.post)
-                if self.post.id in self.post_cache:
-                    self.post_cache.pop(self.post.id)
-                self.post.delete()
+                # keep what we know, so that cancelling can restore it
+                post = self.post_cache.get(id)
+                entry = self.get_store().get(id)
+                if post:
+                    data, comments = post.data(), [comment.data() for comment in post.comments]
+                elif entry:
+                    data, comments = entry.data, entry.comments
+                else:
+                    data, comments = None, []
+                home = id in self.home_index
+                self.home_index.remove(id)
+                self.search_index.remove(id)
+                self.search_info.pop(id, None)
+                self.post_cache.pop(id)
+                self.get_store().delete(id)
+                if self.post and str(self.post.id) == id:
+                    self.post = None
+                self.enqueue("delete post", post = id, data = data, comments = comments,
+                             etag = entry.etag if entry else None, home = home)
                 print("Post deleted.")
                 return
             if words[0] == "comment":
                 words = line.strip().split()
-                if len(words) == 4:
-                    post = self.post_cache[words[3]]
-                    post.delete_comment(words[1])
-                    comments = [c.id for c in post.comments if c.id != words[1]]
-                    post.comments = diaspy.models.Comments(comments)
+                if len(words) == 4 and words[2] == "from":
+                    post = self.post_cache.get(words[3])
+                    comment = post.comments.remove(words[1]) if post else None
+                    if comment:
+                        update_comment_count(post)
+                        self.get_store().put(post)
+                        self.index(post)
+                    self.enqueue("delete comment", post = words[3], comment = words[1],
+                                 data = comment.data() if comment else None)
                     print("Comment deleted.")
                     return
                 if self.post == None:
                     print("Use the 'show' command to show a post, first.")
                     return
-                if len(words) == 2:
+                if len(words) >= 2:
                     try:
-                        n = int(words[1])
-                        comment = self.post.comments[n-1]
-                        id = comment.id
+                        numbers = parse_numbers(words[1:], comment_count(self.post))
+                        self.load_comments(self.post, min(numbers) - 1)
+                        ids = [self.post.comments[n-1].id for n in numbers]
                     except ValueError:
-                        print("Deleting a comment requires an integer.")
+                        print("Deleting a comment requires an integer or a range.")
                         return
                     except IndexError:
                         print("Use the 'comments' command to find valid comment numbers.")
                         return
-                    # not catching any errors from diaspy
-                    self.post.delete_comment(id)
-                    # there is no self.post.comments.remove(id)
-                    comments = [c.id for c in self.post.comments if c.id != id]
-                    self.post.comments = diaspy.models.Comments(comments)
-                    print("Comment deleted.")
+                    self.start_group()
+                    for id in ids:
+                        comment = self.post.comments.remove(id)
+                        self.enqueue("delete comment", post = str(self.post.id), comment = str(id),
+                                     data = comment.data())
+                    self.end_group()
+                    update_comment_count(self.post)
+                    self.get_store().put(self.post)
+                    self.index(self.post)
+                    if len(ids) == 1:
+                        print("Comment deleted.")
+                    else:
+                        print("%d comments deleted." % len(ids))
                     return
                 else:
-                    print("Deleting a comment requires a comment id and a post id, or a number.")
+                    print("Deleting a comment requires a comment id and a post id, or numbers.")
                     print("delete comment <comment id> from <post id>")
                     print("delete comment 5")
+                    print("delete comment 3-7 9")
                     return
             if words[0] == "note":
                 if len(words) == 1:
                     print("Deleting which note?")
                     return
                 notes = self.get_notes()
-                if words[1] in notes:
-                    os.unlink(self.get_note_path(words[1]))
-                    print("Deleted note '%s'." % words[1])
-                else:
-                    print("There is no such note.")
+                # a name with spaces, or several names
+                names = [words[1]] if words[1] in notes else words[1].split()
+                for name in names:
+                    if name not in notes:
+                        print("There is no note called '%s'." % name)
+                        return
+                self.start_group()
+                for name in names:
+                    # keep it as a backup, like editors do, so that it can be restored
+                    os.replace(self.get_note_path(name), self.get_note_path(name + "~"))
+                    self.push_undo("notes restore %s" % name)
+                    print("Deleted note '%s'." % name)
+                self.end_group()
+                self.get_notes_index().invalidate()
             else:
                 print("Things to delete: post, comment, note.")
                 return
@@ -615,7 +2916,18 @@ Use the 'edit' command to edit notes."""
         if not self.undo:
             print("There is nothing to undo.")
             return
-        return self.onecmd(self.undo.pop())
+        with self.undo_lock:
+            entry = self.undo.pop()
+        self.start_group()
+        for command in reversed(entry) if isinstance(entry, list) else [entry]:
+            if command.startswith("#"):
+                print(command[1:].strip())
+            elif command.startswith("outbox cancel "):
+                # if it is being sent, wait and undo what was sent
+                self.dequeue(int(command.split()[2]), wait = True)
+            else:
+                self.onecmd(command)
+        self.end_group()
 
     def do_edit(self, line):
         """Edit a note with a given name."""
@@ -628,6 +2940,7 @@ Use the 'edit' command to edit notes."""
             command.append(file)
             try:
                 subprocess.run(command)
+                self.get_notes_index().invalidate()
                 self.onecmd("notes")
             except FileNotFoundError:
                 print("Could not execute '%s'. Use the 'editor' command to change the editor." % self.editor)
@@ -640,9 +2953,35 @@ Use the 'edit' command to edit notes."""
         return [note for note in notes if note.startswith(text)]
 
     def do_notes(self, line):
-        """List notes"""
+        """List notes.
+Use 'notes search' and some words to list the notes containing all
+of them, best matches first.
+Use 'notes restore' and a name to restore a deleted note."""
+        words = line.split()
+        if words and words[0] == "restore":
+            name = line.strip()[len("restore"):].strip()
+            backup = self.get_note_path(name + "~")
+            if not name or not os.path.exists(backup):
+                print("There is no deleted note called '%s'." % name)
+            elif os.path.exists(self.get_note_path(name)):
+                print("There already is a note called '%s'." % name)
+            else:
+                os.replace(backup, self.get_note_path(name))
+                self.get_notes_index().invalidate()
+                print("Restored note '%s'." % name)
+            return
+        if words and words[0] == "search":
+            if len(words) == 1:
+                print("Search for what?")
+                return
+            notes = self.get_notes_index().search(words[1:])
+            for note in notes:
+                print(self.header(note))
+            if not notes:
+                print("No note contains these words.")
+            return
         if line != "":
-            print("The 'notes' command does not take an argument.")
+            print("The 'notes' command only takes 'search' or 'restore' as an argument.")
             return
         notes = self.get_notes()
         if notes:
@@ -655,18 +2994,23 @@ Use the 'edit' command to edit notes."""
         else:
             print("Use 'edit' to create a note.")
 
+    def get_notes_index(self):
+        """Get the notes index, finding the notes directory if necessary."""
+        if self.notes_index == None:
+            self.notes_index = NotesIndex(get_notes_dir())
+        return self.notes_index
+
     def get_notes(self):
         """Get the list of notes."""
-        return sorted([dir for dir in os.listdir(get_notes_dir()) if not dir.endswith("~")])
+        return self.get_notes_index().list()
 
     def get_note_path(self, filename):
         """Get the correct path for a note."""
-        return os.path.join(get_notes_dir(), filename)
+        return os.path.join(self.get_notes_index().dir, filename)
 
     def read_note(self, filename):
         """Get text of a note."""
-        with open(self.get_note_path(filename), mode = 'r', encoding = 'utf-8') as fp:
-            return fp.read()
+        return self.get_notes_index().read(filename)
 
     def do_preview(self, line):
         """Preview a note using your pager.
@@ -677,7 +3021,7 @@ Use the 'pager' command to set your pager to something like 'mdcat'."""
             return
         notes = self.get_notes()
         if line in notes:
-            self.show(self.read_note(line))
+            self.show(self.read_note(line), "note %s" % line)
         else:
             print("There is no such note.")
 
@@ -688,35 +3032,51 @@ Use the 'pager' command to set your pager to something like 'mdcat'."""
     def do_home(self, line):
         """Show the main stream containing the combined posts of the
 followed users and tags and the community spotlights posts if
-the user enabled those."""
-        if line == "":
-            if self.home:
+the user enabled those.
+Only the latest posts are loaded at first. Use 'home more' to load
+older posts; going back from the first post does the same."""
+        if line == "reload":
+            if not self.online():
+                return
+            print("Reloading..." if self.home_index else "Loading...")
+            self.add_home_page(next(self.stream_pages(), []))
+            line = ""
+        elif line == "more":
+            if not self.online():
+                return
+            print("Loading...")
+            added = self.more_home()
+            if not added:
+                print("Cancelled." if self.cancel.is_set() else "There are no older posts.")
+                return
+            # show the older posts we just loaded
+            self.list_home(self.home_index[:added], 0)
+            print()
+            print("Enter a number to select the post.")
+            self.numbers_refer_to = 'home'
+            self.speculate([])
+            return
+        elif self.home_index:
+            if line == "":
                 print("Redisplaying the cached statuses of the home stream.")
                 print("Use the 'reload' argument to reload them.")
+                print("Use the 'more' argument to load older ones.")
                 print("Use the 'all' argument to show them all.")
                 print("Use a number to show only that many.")
                 print("The default is 5.")
-            else:
-                print("Loading...")
-                self.home = diaspy.streams.Stream(self.connection)
-                self.home.fill()
-                for post in self.home:
-                    if post.id not in self.post_cache:
-                        self.post_cache[post.id] = post
-        elif line == "reload":
-            if self.connection == None:
-                print("Use the 'login' command, first.")
-                return
-            if self.home:
-                print("Reloading...")
-                self.home.update()
-                line = ""
-            else:
-                self.home = diaspy.streams.Stream(self.connection)
-                self.home.fill()
+        elif self.home_from_store():
+            print("Retrieved the home stream from the disk cache.")
+        elif not self.online():
+            return
+        else:
+            print("Loading...")
+            self.home_pages = self.stream_pages()
+            self.add_home_page(next(self.home_pages, []))
+            if self.cancel.is_set():
+                self.home_pages = None
 
         n = 5
-        posts = sorted(self.home, key=lambda x: x.data()["created_at"])
+        posts = self.home_index
 
         if line == "all":
             n = None
@@ -724,7 +3084,7 @@ the user enabled those."""
             try:
                 n = int(line.strip())
             except ValueError:
-                print("The 'home' command takes a number as its argument, or 'reload' or 'all'.")
+                print("The 'home' command takes a number as its argument, or 'reload', 'more' or 'all'.")
                 print("The default is to show the last 5 posts.")
                 return
 
@@ -735,21 +3095,170 @@ the user enabled those."""
             start = max(len(posts) - n, 0)
 
         if posts:
-            for n, post in enumerate(posts[start:], start):
-                print()
-                print(self.header("%2d. %s %s") % (n+1, post.data()["created_at"], post.author()))
-                print()
-                self.show(post)
-                print()
-                print("%d comment%s" % (len(post.comments), "s" if len(post.comments) != 1 else ""))
-
+            self.list_home(posts[start:], start)
             print()
             print("Enter a number to select the post.")
             self.numbers_refer_to = 'home'
+            self.speculate([])
+        elif self.cancel.is_set():
+            print("Cancelled.")
         else:
             print("The people you follow have nothing to say.")
             print("The tags you follow are empty. 😢")
 
+    def list_home(self, ids, start):
+        """Show a list of posts from the home stream."""
+        if self.batch:
+            self.emit(self.post_record(n, post) for n, post in
+                      enumerate((self.get_post(id) for id in ids), start) if post)
+        else:
+            self.page(self.home_listing(ids, start), "posts")
+
+    def home_listing(self, ids, start):
+        """Generate the text for a list of posts."""
+        for n, id in enumerate(ids, start):
+            post = self.get_post(id)
+            if post == None:
+                continue
+            count = comment_count(post)
+            yield "\n" + self.header("%2d. %s %s") % (n+1, post.created_at, post.author) + "\n\n"
+            yield str(post) + "\n\n"
+            yield "%d comment%s\n" % (count, "s" if count != 1 else "")
+
+    def stream_pages(self, max_time = None):
+        """Generate the pages of the home stream, newest first.
+Every page is fetched from the pod when it is needed."""
+        while not self.cancel.is_set():
+            params = {"max_time": max_time} if max_time else {}
+            response = self.connection.get("stream.json", params = params,
+                                           headers = {"accept": "application/json"})
+            if response.status_code != 200:
+                print("Cannot load the home stream: %d" % response.status_code)
+                self.status = _EXIT_ERROR
+                return
+            posts = [self.post_from_data(data, []) for data in response.json()]
+            if not posts:
+                return
+            yield posts
+            max_time = min(parse_time(post.created_at) for post in posts)
+
+    def add_home_page(self, posts):
+        """Add a page of posts to the home stream and the caches.
+Return the number of posts that weren't in the home stream."""
+        added = 0
+        for post in posts:
+            self.remember(post)
+            if self.home_index.add(post):
+                added += 1
+        self.get_store().put_stream("home", self.home_index)
+        return added
+
+    def more_home(self):
+        """Load the next page of older posts of the home stream.
+The numbers of the posts we already have go up by the number of
+posts added. Return that number."""
+        if not self.online(quiet = True):
+            return 0
+        if self.home_pages == None:
+            self.home_pages = self.stream_pages(self.home_index.oldest())
+        added = 0
+        for page in self.home_pages:
+            added = self.add_home_page(page)
+            if added:
+                break
+        if self.cancel.is_set():
+            self.home_pages = None # start again from the oldest post
+        if self.numbers_refer_to == 'home' and self.last_number:
+            self.last_number += added
+        return added
+
+    def do_search(self, line):
+        """Search the posts and comments we have seen.
+List the posts containing all the words, in the post or in its
+comments, best matches first. Limit the posts using 'author:' and
+part of a name or address, 'since:' and a date like 2019-08-01, or
+'until:' and a date. Only posts that are in the caches are searched;
+nothing is fetched from the pod."""
+        terms = []
+        authors = []
+        since = None
+        until = None
+        try:
+            for word in line.split():
+                if word.startswith("author:"):
+                    authors.append(word[7:].lower())
+                elif word.startswith("since:"):
+                    since = calendar.timegm(time.strptime(word[6:], "%Y-%m-%d"))
+                elif word.startswith("until:"):
+                    until = calendar.timegm(time.strptime(word[6:], "%Y-%m-%d")) + 24 * 60 * 60
+                else:
+                    terms.append(word)
+        except ValueError:
+            print("Dates must look like 2019-08-01.")
+            return
+        if not terms and not authors and since == None and until == None:
+            print("Search for what?")
+            return
+        self.update_search()
+        if terms:
+            ids = self.search_index.search(terms)
+        else:
+            # newest first
+            ids = sorted(self.search_info, key = lambda id: max(self.search_info[id][2]), reverse = True)
+        def matches(id):
+            (names, times) = self.search_info[id]
+            return (all(any(author in name for name in names) for author in authors)
+                    and any((since == None or t >= since) and (until == None or t < until)
+                            for t in times))
+        self.search_results = [id for id in ids if matches(id)]
+        if not self.search_results:
+            print("Nothing found.")
+            return
+        self.list_home(self.search_results, 0)
+        print()
+        print("Enter a number to select the post.")
+        self.numbers_refer_to = 'search'
+        self.speculate([])
+        self.last_number = None
+
+    def update_search(self):
+        """Add the posts in the disk cache to the search index, the first
+time we search. Posts that are stored later are indexed as they are
+stored; see index."""
+        if not self.search_loaded:
+            self.search_loaded = True
+            for (key, data, comments) in self.get_store().posts():
+                self.index_post(key, data, comments)
+
+    def index(self, post):
+        """Add a post and its comments to the search index."""
+        self.index_post(str(post.id), post.data(), [comment.data() for comment in post.comments])
+
+    def index_post(self, id, data, comments):
+        """Add the data of a post and its comments to the search index."""
+        people = [data.get("author", {})] + [comment.get("author", {}) for comment in comments]
+        names = set(("%s %s" % (person.get("name"), person.get("diaspora_id"))).lower()
+                    for person in people)
+        times = ([parse_time(data.get("created_at", ""))]
+                 + [parse_time(comment.get("created_at", "")) for comment in comments])
+        self.search_index.add(id, "\n".join([data.get("text") or ""]
+                                            + [comment.get("text") or "" for comment in comments]
+                                            + list(names)))
+        self.search_info[id] = (names, times)
+
+    def home_from_store(self):
+        """Get the home stream from the disk cache.
+Only use it if it's fresh, or if we aren't logged in."""
+        ids, fresh = self.get_store().get_stream("home")
+        if ids == None or not fresh and self.online(quiet = True):
+            return False
+        for id in ids:
+            entry = self.get_store().get(id)
+            if entry:
+                post = self.post_from_data(entry.data, entry.comments)
+                self.home_index.add(post)
+        return len(self.home_index) > 0
+
     def do_shortcuts(self, line):
         """List all shortcuts."""
         if line != "":
@@ -781,7 +3290,7 @@ the user enabled those."""
             print("Debug takes two arguments: what to debug, and a number.")
             return
         if words[0] == "post":
-            items = self.home
+            items = [self.get_post(id) for id in self.home_index]
         elif words[0] == "notification":
             items = self.notifications
         elif words[0] == "comments":
@@ -796,10 +3305,37 @@ the user enabled those."""
             print("Debugging a %s requires an integer." % words[0])
             return
         except IndexError:
-            print("There is no %s #%d" % n)
+            print("There is no %s #%s" % (words[0], words[1]))
             return
         print(self.header("Debug %s #%d" % (words[0], n)))
-        print(item.__dict__)
+        # posts and comments are records without a __dict__
+        print(item.data() if isinstance(item, CommentRecord) else item.__dict__)
+
+def run_batch(c, commands):
+    """Run the queued commands and then the given commands without the
+command loop. Wait for the outbox to be sent. Return the exit status."""
+    lines = c.cmdqueue + list(commands)
+    c.cmdqueue = []
+    for line in lines:
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        try:
+            line = c.precmd(line)
+            c.postcmd(c.onecmd(line), line)
+        except Exception as e:
+            print("%s: %s" % (line, e))
+            c.status = _EXIT_ERROR
+    c.report_startup()
+    deadline = time.time() + 60
+    while c.store and time.time() < deadline and c.online(quiet = True):
+        if not [item for item in c.get_store().outbox() if item.attempts < c.max_attempts]:
+            break
+        time.sleep(0.1)
+    if c.store and c.get_store().outbox():
+        print("%d items left in the outbox." % len(c.get_store().outbox()))
+        c.status = _EXIT_ERROR
+    return c.status
 
 # Main function
 def main():
@@ -808,10 +3344,29 @@ def main():
     parser = argparse.ArgumentParser(description='A command line Diaspora client.')
     parser.add_argument('--no-init-file', dest='init_file', action='store_const',
                         const=False, default=True, help='Do not load a init file')
+    parser.add_argument('-c', '--command', dest='commands', action='append', default=[],
+                        help='Run this command and exit; may be repeated')
+    parser.add_argument('--batch', action='store_true',
+                        help='Run the commands read from standard input and exit')
+    parser.epilog = ('In batch mode, notifications, posts and comments are written to standard output '
+                     'as JSON Lines and all other output goes to standard error. The exit status is '
+                     '0 on success, 1 if a command failed, 3 if not logged in or offline, and 4 if '
+                     'the login failed.')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Print how long each phase of the startup took to standard error')
     args = parser.parse_args()
 
     # Instantiate client
     c = DiasporaClient()
+    if args.profile_startup:
+        c.timings = [("imports", _IMPORTED - _START)]
+        c.last_mark = _IMPORTED
+        c.mark("client")
+    c.batch = args.batch or len(args.commands) > 0
+    if c.batch:
+        # everything but the JSON Lines goes to stderr
+        c.json_output = sys.stdout
+        sys.stdout = sys.stderr
 
     # Process init file
     seen_pager = False
@@ -831,6 +3386,7 @@ def main():
                         seen_editor = line.startswith("editor ");
         else:
             print("Use the 'save' command to save your login sequence to an init file.")
+    c.mark("init file")
 
     if not seen_pager:
         # prepend
@@ -839,6 +3395,9 @@ def main():
         # prepend
         c.cmdqueue.insert(0, "editor %s" % get_editor())
 
+    if c.batch:
+        sys.exit(run_batch(c, args.commands or sys.stdin))
+
     # Endless interpret loop
     while True:
         try: